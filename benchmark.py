@@ -0,0 +1,929 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2014 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Benchmarks for revisor, using synthetic Gerrit data.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+from bisect import bisect
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+
+description = """
+Benchmarks for revisor, using synthetic Gerrit data.
+
+Produces synthetic JSON documents like those obtained with the gerrit
+command (ssh_miner.py) and with the Gerrit HTTP API (revisor.py),
+with changes, patchsets, approvals and comments, by a set of people
+and for a set of projects with realistic (Zipf-like) distributions.
+Then, runs benchmarks on them, using SQLite databases.
+
+Examples:
+
+Produce a JSON document with 10,000 changes:
+
+benchmark.py --generate /tmp/changes.json --changes 10000
+
+Run all benchmarks for 10,000 changes, appending results to a file:
+
+benchmark.py --changes 10000 --results bench_results.jsonl
+
+"""
+
+# Benchmarks that can be run (see --bench)
+BENCHMARKS = ["load", "load_deferred", "load_rejects", "rest", "header",
+              "report", "startup"]
+
+# One in this number of changes is spoiled (see bad_changes)
+BAD_EVERY = 100
+
+# Start and end of the period for synthetic changes (timestamps)
+PERIOD_START = 1325376000 # 2012-01-01
+PERIOD_END = 1412121600 # 2014-10-01
+
+def parse_args ():
+    """
+    Parse command line arguments
+
+    """
+
+    parser = argparse.ArgumentParser(description = description)
+    parser.add_argument("--changes",
+                        help = "Number of changes to produce " + \
+                            "(default: 1000).",
+                        type = int, default = 1000
+                        )
+    parser.add_argument("--projects",
+                        help = "Number of projects to produce " + \
+                            "(default: 200).",
+                        type = int, default = 200
+                        )
+    parser.add_argument("--people",
+                        help = "Number of people to produce " + \
+                            "(default: changes / 10 + 50).",
+                        type = int
+                        )
+    parser.add_argument("--seed",
+                        help = "Seed for the random generator " + \
+                            "(default: 0).",
+                        type = int, default = 0
+                        )
+    parser.add_argument("--generate",
+                        help = "Only produce a JSON document, as " + \
+                            "produced by the gerrit command, " + \
+                            "in this file."
+                        )
+    parser.add_argument("--generate_rest",
+                        help = "Only produce JSON documents, as " + \
+                            "produced by the Gerrit HTTP API, " + \
+                            "in this directory (one per page)."
+                        )
+    parser.add_argument("--bench",
+                        help = "Benchmarks to run, separated by commas " + \
+                            "(default: all: " + ",".join(BENCHMARKS) + ")."
+                        )
+    parser.add_argument("--workdir",
+                        help = "Directory for JSON documents and " + \
+                            "databases (default: /tmp/revisor_bench).",
+                        default = "/tmp/revisor_bench"
+                        )
+    parser.add_argument("--results",
+                        help = "File to append results to, " + \
+                            "one JSON document per line."
+                        )
+    args = parser.parse_args()
+    return args
+
+class Zipf (object):
+    """Random chooser of items following a Zipf-like distribution.
+
+    The first items are much more likely to be chosen than the last
+    ones, as happens with people active in a project, or with changes
+    per project.
+
+    """
+
+    def __init__ (self, items, rnd, exponent = 1.1):
+        """Initialize the chooser.
+
+        Parameters
+        ----------
+
+        items: list
+            Items to choose from, most likely first.
+        rnd: random.Random
+            Random generator to use.
+        exponent: float
+            Exponent of the distribution (Default: 1.1).
+
+        """
+
+        self.items = items
+        self.rnd = rnd
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(items) + 1):
+            total = total + 1.0 / (rank ** exponent)
+            self.cumulative.append (total)
+        self.total = total
+
+    def choose (self):
+        """Choose an item.
+
+        """
+
+        return self.items[bisect(self.cumulative,
+                                 self.rnd.random() * self.total)]
+
+def gen_people (number):
+    """Produce a list of people, as found in Gerrit JSON documents.
+
+    Some of them lack email or username, as happens with bots or
+    with old accounts.
+
+    Parameters
+    ----------
+
+    number: int
+        Number of people to produce.
+
+    Returns
+    -------
+
+    list of dict: people.
+
+    """
+
+    people = [{"name": "jenkins-bot"}]
+    for count in range(1, number):
+        person = {"name": "Person " + str(count)}
+        if count % 17 != 0:
+            person["email"] = "person" + str(count) + "@example.org"
+        if count % 23 != 0:
+            person["username"] = "person" + str(count)
+        people.append (person)
+    return people
+
+def gen_projects (number):
+    """Produce a list of project names, most active first.
+
+    Parameters
+    ----------
+
+    number: int
+        Number of projects to produce.
+
+    Returns
+    -------
+
+    list of str: project names.
+
+    """
+
+    projects = ["mediawiki/core"]
+    for count in range(1, number):
+        projects.append ("mediawiki/extensions/Extension" + str(count))
+    return projects
+
+def gen_changes (changes, projects = 200, people = None, seed = 0):
+    """Produce synthetic changes, as found in gerrit command JSON documents.
+
+    Each change has a Zipf-distributed project and owner, several
+    patchsets (each with its upload comment, reviews, verification
+    and approvals), and ends merged, abandoned or still open.
+
+    Parameters
+    ----------
+
+    changes: int
+        Number of changes to produce.
+    projects: int
+        Number of projects (Default: 200).
+    people: int
+        Number of people (Default: None, means changes / 10 + 50).
+    seed: int
+        Seed for the random generator (Default: 0).
+
+    Returns
+    -------
+
+    generator of dict: changes, in ascending order of change number.
+
+    """
+
+    rnd = random.Random(seed)
+    if people is None:
+        people = changes / 10 + 50
+    persons = gen_people (people)
+    bot = persons[0]
+    owners = Zipf(persons[1:], rnd)
+    reviewers = Zipf(persons[1:], rnd, exponent = 0.9)
+    project_names = Zipf(gen_projects (projects), rnd)
+    for number in range(1, changes + 1):
+        owner = owners.choose()
+        project = project_names.choose()
+        created = rnd.randint(PERIOD_START, PERIOD_END)
+        date = created
+        outcome = rnd.random()
+        if outcome < 0.7:
+            status = "MERGED"
+        elif outcome < 0.85:
+            status = "ABANDONED"
+        else:
+            status = "NEW"
+        patchsets = []
+        comments = []
+        for patchset in range(1, int(rnd.expovariate(0.6)) + 2):
+            date = date + int(rnd.expovariate(1.0 / 86400))
+            uploaded = date
+            revision = "%040x" % rnd.getrandbits(160)
+            comments.append ({"timestamp": date, "reviewer": owner,
+                              "message": "Uploaded patch set " \
+                                  + str(patchset) + "."})
+            approvals = []
+            date = date + int(rnd.expovariate(1.0 / 600))
+            verified = rnd.choice([-1, 1, 1, 1])
+            approvals.append ({"type": "VRIF", "description": "Verified",
+                               "value": str(verified), "grantedOn": date,
+                               "by": bot})
+            comments.append ({"timestamp": date, "reviewer": bot,
+                              "message": "Patch Set " + str(patchset) \
+                                  + ": Verified%+d" % verified \
+                                  + "\n\nBuild " + ("succeeded." \
+                                  if verified > 0 else "failed.")})
+            for review in range(rnd.randint(0, 3)):
+                date = date + int(rnd.expovariate(1.0 / 43200))
+                reviewer = reviewers.choose()
+                value = rnd.choice([-1, 0, 1, 1, 2])
+                approvals.append ({"type": "CRVW",
+                                   "description": "Code Review",
+                                   "value": str(value), "grantedOn": date,
+                                   "by": reviewer})
+                comments.append ({"timestamp": date, "reviewer": reviewer,
+                                  "message": "Patch Set " \
+                                      + str(patchset) \
+                                      + ": Code-Review%+d" % value \
+                                      + "\n\n" + "Some review comment. " \
+                                      * rnd.randint(0, 20)})
+            patchsets.append ({"number": str(patchset),
+                               "revision": revision,
+                               "ref": "refs/changes/%02d/%d/%d" % \
+                                   (number % 100, number, patchset),
+                               "uploader": owner,
+                               "createdOn": uploaded,
+                               "isDraft": False,
+                               "approvals": approvals})
+        date = date + int(rnd.expovariate(1.0 / 86400))
+        if status == "MERGED":
+            merger = reviewers.choose()
+            patchsets[-1]["approvals"].append (
+                {"type": "SUBM", "description": "Submitted",
+                 "value": "1", "grantedOn": date, "by": merger})
+            comments.append ({"timestamp": date, "reviewer": merger,
+                              "message": "Change has been successfully " \
+                                  + "merged into the git repository."})
+        elif status == "ABANDONED":
+            comments.append ({"timestamp": date, "reviewer": owner,
+                              "message": "Patch Set " \
+                                  + str(len(patchsets)) + ": Abandoned"})
+        # Keys in the same order as the gerrit command writes them
+        change = OrderedDict([
+                ("project", project),
+                ("branch", "master"),
+                ("id", "I%040x" % rnd.getrandbits(160)),
+                ("number", str(number)),
+                ("subject", "Synthetic change " + str(number)),
+                ("owner", owner),
+                ("url", "https://gerrit.example.org/r/" + str(number)),
+                ("createdOn", created),
+                ("lastUpdated", date),
+                ("sortKey", "%016x" % ((date << 24) + number)),
+                ("open", status == "NEW"),
+                ("status", status),
+                ("comments", comments),
+                ("patchSets", patchsets)])
+        if rnd.random() < 0.1:
+            change["topic"] = "topic" + str(rnd.randint(1, 50))
+        yield change
+
+def bad_changes (changes, every = BAD_EVERY):
+    """Spoil some changes, as happens with bad data in real dumps.
+
+    One in every changes gets comments by two new people (the first
+    one is stored when looking for the second one), and loses the
+    revision of its first patchset (so that it is rejected when
+    loaded). The next change gets comments by two other new people,
+    and then a comment by the first new person, who has to be stored
+    again then (with an id which may be taken by the others).
+
+    Parameters
+    ----------
+
+    changes: iterable of dict
+        Changes to spoil (see gen_changes).
+    every: int
+        One in this number of changes is spoiled (Default: BAD_EVERY).
+
+    Returns
+    -------
+
+    generator of dict: changes.
+
+    """
+
+    def person (name, count):
+        return {"name": name.capitalize() + " Person " + str(count),
+                "email": name + str(count) + "@example.org",
+                "username": name + str(count)}
+
+    def comment (change, reviewer):
+        return {"timestamp": change["createdOn"], "reviewer": reviewer,
+                "message": "Some comment."}
+
+    new = None
+    for count, change in enumerate (changes):
+        if new is not None:
+            change["comments"].extend ([
+                    comment (change, person ("other", count)),
+                    comment (change, person ("another", count)),
+                    comment (change, new)])
+            new = None
+        if count % every == every - 1:
+            new = person ("new", count)
+            # First, so that people are stored before the change fails
+            change["comments"][:0] = [
+                comment (change, new),
+                comment (change, person ("extra", count))]
+            del change["patchSets"][0]["revision"]
+        yield change
+
+def write_changes (filename, changes):
+    """Write changes to a file, as the gerrit command (ssh_miner.py) does.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the file to write.
+    changes: iterable of dict
+        Changes to write (see gen_changes).
+
+    Returns
+    -------
+
+    int: Number of changes written.
+
+    """
+
+    count = 0
+    with open (filename, "w") as file:
+        for change in changes:
+            file.write (json.dumps(change, separators = (',', ':')) + "\n")
+            count = count + 1
+    return count
+
+def format_date (timestamp):
+    """Format a timestamp as a date in the Gerrit HTTP API.
+
+    """
+
+    return datetime.utcfromtimestamp(timestamp) \
+        .strftime("%Y-%m-%d %H:%M:%S.000000000")
+
+def rest_change (change):
+    """Produce a change as found in the Gerrit HTTP API.
+
+    Parameters
+    ----------
+
+    change: dict
+        Change as produced by gen_changes.
+
+    Returns
+    -------
+
+    dict: change, with messages and revisions.
+
+    """
+
+    messages = []
+    for count, comment in enumerate (change["comments"]):
+        message = {"id": "%08x" % (int(change["number"]) * 1000 + count),
+                   "date": format_date (comment["timestamp"]),
+                   "message": comment["message"]}
+        if comment["message"].startswith ("Patch Set "):
+            message["_revision_number"] = \
+                int(comment["message"].split(" ")[2].rstrip(":"))
+        messages.append (message)
+    revisions = {}
+    for patchset in change["patchSets"]:
+        revisions[patchset["revision"]] = \
+            {"_number": int(patchset["number"])}
+    rest = {"kind": "gerritcodereview#change",
+            "id": change["project"].replace("/", "%2F") + "~" \
+                + change["branch"] + "~" + change["id"],
+            "project": change["project"],
+            "branch": change["branch"],
+            "change_id": change["id"],
+            "subject": change["subject"],
+            "status": change["status"],
+            "created": format_date (change["createdOn"]),
+            "updated": format_date (change["lastUpdated"]),
+            "mergeable": change["open"],
+            "_sortkey": change["sortKey"],
+            "_number": int(change["number"]),
+            "messages": messages,
+            "revisions": revisions}
+    if "topic" in change:
+        rest["topic"] = change["topic"]
+    return rest
+
+def rest_pages (changes, size = 300):
+    """Produce pages as served by the Gerrit HTTP API, by status.
+
+    Pages for each status are ordered by decreasing sortkey, and the
+    last change of each page (but the last one) has "_more_changes".
+    Pages are in text form (first line is the XSSI protection prefix).
+
+    Parameters
+    ----------
+
+    changes: iterable of dict
+        Changes as produced by gen_changes.
+    size: int
+        Changes per page (Default: 300).
+
+    Returns
+    -------
+
+    dict: lists of pages (str) by status ("open", "merged", "abandoned").
+
+    """
+
+    statuses = {"NEW": "open", "MERGED": "merged", "ABANDONED": "abandoned"}
+    by_status = {"open": [], "merged": [], "abandoned": []}
+    for change in changes:
+        by_status[statuses[change["status"]]].append (rest_change (change))
+    pages = {}
+    for status, status_changes in by_status.items():
+        status_changes.sort (key = lambda change: change["_sortkey"],
+                             reverse = True)
+        pages[status] = []
+        for start in range(0, max(len(status_changes), 1), size):
+            page = status_changes[start:start + size]
+            if start + size < len(status_changes):
+                page[-1]["_more_changes"] = True
+            pages[status].append (")]}'\n" + json.dumps(page))
+    return pages
+
+def serve_rest (pages):
+    """Serve pages as the Gerrit HTTP API does, in a background thread.
+
+    Only queries as those performed by revisor.get_changes are
+    supported: the status is taken from the q argument, and the
+    page from the N argument (sortkey to resume from).
+
+    Parameters
+    ----------
+
+    pages: dict
+        Pages by status, as produced by rest_pages.
+
+    Returns
+    -------
+
+    BaseHTTPServer.HTTPServer: server (already serving).
+
+    """
+
+    # Page index by (status, sortkey of last change of previous page)
+    resume = {}
+    for status, status_pages in pages.items():
+        for count, page in enumerate (status_pages[:-1]):
+            last = json.loads(page.split("\n", 1)[1])[-1]
+            resume[(status, last["_sortkey"])] = count + 1
+
+    class Handler (BaseHTTPRequestHandler):
+
+        def do_GET (self):
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            status = query["q"][0].split(" ")[0].split(":")[1]
+            if "N" in query:
+                page = pages[status][resume[(status, query["N"][0])]]
+            else:
+                page = pages[status][0]
+            self.send_response (200)
+            self.send_header ("Content-Type", "application/json")
+            self.end_headers ()
+            self.wfile.write (page)
+
+        def log_message (self, format, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def run_script (command, stats_file):
+    """Run a revisor script, and return its wall time and stats summary.
+
+    Parameters
+    ----------
+
+    command: list of str
+        Script and arguments (the script is run by this Python).
+    stats_file: str
+        File for the summary of the run (see telemetry.Telemetry.emit).
+
+    Returns
+    -------
+
+    dict: "seconds" (wall time), and "stats" (summary of the run).
+
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, os.path.join(directory, command[0])] \
+        + command[1:] + ["--stats", stats_file]
+    started = time.time()
+    with open (os.devnull, "w") as devnull:
+        subprocess.check_call (command, stdout = devnull, stderr = devnull)
+    seconds = time.time() - started
+    with open (stats_file, "r") as stats:
+        summary = json.loads(stats.read())
+    return {"seconds": round(seconds, 3), "stats": summary}
+
+def bench_load (dump, database, deferred = False):
+    """Benchmark loading a JSON document with revisor_json.py.
+
+    Parameters
+    ----------
+
+    dump: str
+        JSON document, as produced by the gerrit command.
+    database: str
+        SQLite file to load to (removed if already present).
+    deferred: bool
+        Load with --deferred (Default: False).
+
+    Returns
+    -------
+
+    dict: results (see run_script).
+
+    """
+
+    if os.path.exists(database):
+        os.remove(database)
+    command = ["revisor_json.py", dump, "sqlite:///" + database]
+    if deferred:
+        command.append ("--deferred")
+    return run_script (command, database + ".stats")
+
+def bench_load_rejects (dump, database, rejected):
+    """Benchmark loading a JSON document with bad changes (see bad_changes).
+
+    The load has to end with the bad changes rejected, and only the
+    rest counted as loaded.
+
+    Parameters
+    ----------
+
+    dump: str
+        JSON document, with bad changes.
+    database: str
+        SQLite file to load to (removed if already present).
+    rejected: int
+        Number of bad changes in the document.
+
+    Returns
+    -------
+
+    dict: results (see run_script).
+
+    """
+
+    for filename in [database, database + ".rejects"]:
+        if os.path.exists(filename):
+            os.remove(filename)
+    results = run_script (["revisor_json.py", dump, "sqlite:///" + database,
+                           "--rejects", database + ".rejects"],
+                          database + ".stats")
+    rows = results["stats"]["rows"]
+    with open (dump, "r") as dump_file:
+        changes = sum([1 for line in dump_file])
+    found = (rows.get("rejected", {}).get("rows", 0),
+             rows.get("changes", {}).get("rows", 0))
+    if found != (rejected, changes - rejected):
+        raise RuntimeError ("Bad load: %d rejected, %d changes " % found +
+                            "(expected %d, %d)" % (rejected,
+                                                   changes - rejected))
+    return results
+
+def bench_rest (pages, database):
+    """Benchmark retrieving from the Gerrit HTTP API with revisor.py.
+
+    Parameters
+    ----------
+
+    pages: dict
+        Pages by status, as produced by rest_pages.
+    database: str
+        SQLite file to store to (removed if already present).
+
+    Returns
+    -------
+
+    dict: results (see run_script).
+
+    """
+
+    if os.path.exists(database):
+        os.remove(database)
+    server = serve_rest (pages)
+    try:
+        url = "http://127.0.0.1:" + str(server.server_address[1])
+        return run_script (["revisor.py", url,
+                            "--database", "sqlite:///" + database],
+                           database + ".stats")
+    finally:
+        server.shutdown()
+
+def bench_header (dump, repeat = 3):
+    """Benchmark revisor.analyze_header on headers in a JSON document.
+
+    Parameters
+    ----------
+
+    dump: str
+        JSON document, as produced by the gerrit command.
+    repeat: int
+        Number of times to analyze all headers (best time is kept)
+        (Default: 3).
+
+    Returns
+    -------
+
+    dict: "seconds" (best time), "headers" (number of headers analyzed).
+
+    """
+
+    from revisor import analyze_header
+
+    headers = []
+    for line in open (dump, "r"):
+        for comment in json.loads(line).get("comments", []):
+            headers.append (comment["message"].split('\n', 1)[0])
+    best = None
+    for count in range(repeat):
+        started = time.time()
+        for header in headers:
+            analyze_header (header)
+        seconds = time.time() - started
+        if best is None or seconds < best:
+            best = seconds
+    return {"seconds": round(best, 3), "headers": len(headers)}
+
+def bench_report (database):
+    """Benchmark report.get_events, report.get_start_end, and events by period.
+
+    Events by period are counted both in pandas and in SQL (see
+    report.get_events_byperiod, report.get_events_byperiod_sql), for
+    each length of period, and have to be the same.
+    Needs a database loaded by revisor_json.py (see bench_load), and
+    the dependencies of report.py (grimoirelib_alch, pandas).
+
+    Parameters
+    ----------
+
+    database: str
+        SQLite file with the database.
+
+    Returns
+    -------
+
+    dict: seconds for each benchmarked function.
+
+    """
+
+    import report
+    from query_gerrit import DB, Query
+
+    (directory, schema) = os.path.split(os.path.abspath(database))
+    db = DB (url = "sqlite:///" + directory + "/",
+             schema = schema,
+             schema_id = schema)
+    report.session = db.build_session(Query, echo = False)
+    results = {}
+    kinds = ["start", "submit", "push", "abandon"]
+    started = time.time()
+    events = report.get_events (kinds, 0)
+    results["get_events"] = round(time.time() - started, 3)
+    results["events"] = len(events)
+    started = time.time()
+    report.get_start_end (events)
+    results["get_start_end"] = round(time.time() - started, 3)
+    (seconds, seconds_sql) = (0, 0)
+    for period in ["day", "week", "month"]:
+        started = time.time()
+        byperiod = report.get_events_byperiod (events, period)
+        seconds = seconds + time.time() - started
+        started = time.time()
+        byperiod_sql = report.get_events_byperiod_sql (kinds, 0,
+                                                       period = period)
+        seconds_sql = seconds_sql + time.time() - started
+        if not byperiod.equals(byperiod_sql):
+            raise RuntimeError ("Events by " + period + " differ " +
+                                "counted in pandas and in SQL")
+    results["get_events_byperiod"] = round(seconds, 3)
+    results["get_events_byperiod_sql"] = round(seconds_sql, 3)
+    return results
+
+def bench_startup (database, runs = 5):
+    """Benchmark startup of report.py, for a simple report (--summary).
+
+    Needs a database loaded by revisor_json.py (see bench_load), and
+    the dependencies of report.py needed for the summary
+    (grimoirelib_alch).
+
+    Parameters
+    ----------
+
+    database: str
+        SQLite file with the database.
+    runs: int
+        Number of runs (best time is kept) (Default: 5).
+
+    Returns
+    -------
+
+    dict: "seconds" (best wall time for report.py --summary), and
+        "python" (best wall time for starting Python and doing
+        nothing, for reference).
+
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    (db_directory, schema) = os.path.split(os.path.abspath(database))
+    commands = {
+        "seconds": [sys.executable, os.path.join(directory, "report.py"),
+                    "--summary", "sqlite:///" + db_directory + "/", schema],
+        "python": [sys.executable, "-c", "pass"]
+        }
+    results = {}
+    with open (os.devnull, "w") as devnull:
+        for name, command in commands.items():
+            best = None
+            for count in range(runs):
+                started = time.time()
+                subprocess.check_call (command, stdout = devnull,
+                                       stderr = devnull)
+                seconds = time.time() - started
+                if best is None or seconds < best:
+                    best = seconds
+            results[name] = round(best, 3)
+    return results
+
+def git_revision ():
+    """Find the git revision of the code being benchmarked, if possible.
+
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open (os.devnull, "w") as devnull:
+            return subprocess.check_output (
+                ["git", "rev-parse", "HEAD"], cwd = directory,
+                stderr = devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    def changes ():
+        return gen_changes (args.changes, projects = args.projects,
+                            people = args.people, seed = args.seed)
+
+    if args.generate or args.generate_rest:
+        if args.generate:
+            written = write_changes (args.generate, changes())
+            print "Changes written to " + args.generate + ": " + str(written)
+        if args.generate_rest:
+            if not os.path.isdir(args.generate_rest):
+                os.makedirs(args.generate_rest)
+            for status, pages in rest_pages (changes()).items():
+                for count, page in enumerate (pages):
+                    filename = os.path.join(args.generate_rest,
+                                            "%s_%04d.json" % (status, count))
+                    with open (filename, "w") as file:
+                        file.write (page)
+            print "Pages written to " + args.generate_rest
+        sys.exit(0)
+
+    if args.bench:
+        benchmarks = args.bench.split(",")
+    else:
+        benchmarks = BENCHMARKS
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    name = "changes_%d_%d" % (args.changes, args.seed)
+    dump = os.path.join(args.workdir, name + ".json")
+    database = os.path.join(args.workdir, name + ".db")
+    if not os.path.exists(dump):
+        write_changes (dump, changes())
+
+    results = {}
+    if "load" in benchmarks or "report" in benchmarks \
+            or "startup" in benchmarks:
+        print "Benchmark: load"
+        results["load"] = bench_load (dump, database)
+        print "  %.3f secs." % results["load"]["seconds"]
+    if "load_deferred" in benchmarks:
+        print "Benchmark: load_deferred"
+        results["load_deferred"] = bench_load (
+            dump, os.path.join(args.workdir, name + "_deferred.db"),
+            deferred = True)
+        print "  %.3f secs." % results["load_deferred"]["seconds"]
+    if "load_rejects" in benchmarks:
+        print "Benchmark: load_rejects"
+        bad_dump = os.path.join(args.workdir, name + "_bad.json")
+        if not os.path.exists(bad_dump):
+            write_changes (bad_dump, bad_changes (changes()))
+        results["load_rejects"] = bench_load_rejects (
+            bad_dump, os.path.join(args.workdir, name + "_bad.db"),
+            args.changes / BAD_EVERY)
+        print "  %.3f secs." % results["load_rejects"]["seconds"]
+    if "rest" in benchmarks:
+        print "Benchmark: rest"
+        results["rest"] = bench_rest (
+            rest_pages (changes()),
+            os.path.join(args.workdir, name + "_rest.db"))
+        print "  %.3f secs." % results["rest"]["seconds"]
+    if "header" in benchmarks:
+        print "Benchmark: header"
+        results["header"] = bench_header (dump)
+        print "  %.3f secs." % results["header"]["seconds"]
+    if "report" in benchmarks:
+        print "Benchmark: report"
+        try:
+            results["report"] = bench_report (database)
+            print "  get_events: %.3f secs., get_start_end: %.3f secs." % \
+                (results["report"]["get_events"],
+                 results["report"]["get_start_end"])
+        except ImportError as error:
+            print "  Skipped (" + str(error) + ")."
+    if "startup" in benchmarks:
+        print "Benchmark: startup"
+        try:
+            results["startup"] = bench_startup (database)
+            print "  report.py --summary: %.3f secs. (python: %.3f secs.)" \
+                % (results["startup"]["seconds"],
+                   results["startup"]["python"])
+        except subprocess.CalledProcessError:
+            print "  Skipped (report.py failed, missing dependencies?)."
+
+    record = {"date": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+              "revision": git_revision(),
+              "changes": args.changes,
+              "projects": args.projects,
+              "people": args.people,
+              "seed": args.seed,
+              "results": results}
+    if args.results:
+        with open (args.results, "a") as results_file:
+            results_file.write (json.dumps(record, sort_keys = True) + "\n")
+        print "Results appended to " + args.results
+    else:
+        print json.dumps(record, sort_keys = True)
@@ -0,0 +1,208 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2014 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Remove repeated changes from JSON files produced by ssh_miner.py.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+import argparse
+import heapq
+import os
+import struct
+import tempfile
+
+from dump_index import open_map, scan_lines
+
+description = """
+Simple script to remove repeated changes from a JSON file produced by
+ssh_miner.py (one change per line), keeping only the latest version
+of each change (the one with the highest lastUpdated, or the last
+one found in the file if several have the same).
+
+The file is processed in bounded memory: (change number, lastUpdated,
+offset, length) entries are sorted in runs of limited size, which are
+stored in temporary files and then merged. The resulting file has
+changes ordered by change number.
+
+Example of use:
+
+dedup_dump.py /tmp/changes.json /tmp/changes_dedup.json
+
+"""
+
+# Run entry: change number, lastUpdated, offset, length
+RUN_ENTRY = struct.Struct("<iqqi")
+
+def parse_args ():
+    """
+    Parse command line arguments
+
+    """
+
+    parser = argparse.ArgumentParser(description = description)
+    parser.add_argument("file",
+                        help = "JSON file with the change records, " \
+                            + "as produced by ssh_miner.py."
+                        )
+    parser.add_argument("output",
+                        help = "JSON file to write the change records " \
+                            + "to, with no repeated changes."
+                        )
+    parser.add_argument("--run_size",
+                        help = "Entries to sort in memory at a time " + \
+                            "(default: 1000000).",
+                        type = int, default = 1000000
+                        )
+    args = parser.parse_args()
+    return args
+
+def write_run (entries, directory):
+    """Sort entries and write them to a temporary file.
+
+    Parameters
+    ----------
+
+    entries: list of tuple
+        Entries (number, updated, offset, length) to sort and write.
+    directory: str
+        Directory for the temporary file.
+
+    Returns
+    -------
+
+    str: name of the temporary file.
+
+    """
+
+    entries.sort()
+    (handle, name) = tempfile.mkstemp(prefix = "dedup_", suffix = ".run",
+                                      dir = directory)
+    with os.fdopen(handle, "wb") as run:
+        for entry in entries:
+            run.write (RUN_ENTRY.pack(*entry))
+    return name
+
+def read_run (name):
+    """Read entries from a temporary file written by write_run.
+
+    Parameters
+    ----------
+
+    name: str
+        Name of the temporary file.
+
+    Returns
+    -------
+
+    generator of tuple: entries (number, updated, offset, length).
+
+    """
+
+    with open (name, "rb") as run:
+        while True:
+            raw = run.read(RUN_ENTRY.size * 4096)
+            if raw == "":
+                break
+            for offset in range(0, len(raw), RUN_ENTRY.size):
+                yield RUN_ENTRY.unpack_from(raw, offset)
+
+def write_line (out, data, entry):
+    """Write the line for an entry to out, ensuring it ends with newline.
+
+    Returns
+    -------
+
+    int: 1 (number of lines written).
+
+    """
+
+    (number, updated, offset, length) = entry
+    line = data[offset:offset + length]
+    if not line.endswith("\n"):
+        line = line + "\n"
+    out.write (line)
+    return 1
+
+def dedup (filename, output, run_size = 1000000, directory = None):
+    """Write changes in filename to output, keeping the latest version of each.
+
+    Parameters
+    ----------
+
+    filename: str
+        JSON file with changes (one per line).
+    output: str
+        JSON file to write changes to (ordered by change number).
+    run_size: int
+        Entries to sort in memory at a time (Default: 1000000).
+    directory: str
+        Directory for temporary files (Default: None, means the
+        directory of output).
+
+    Returns
+    -------
+
+    int: Number of changes read.
+    int: Number of changes written.
+
+    """
+
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(output))
+    data = open_map (filename)
+    read = 0
+    written = 0
+    runs = []
+    try:
+        entries = []
+        if data is not None:
+            for (number, offset, length, updated) in scan_lines (data):
+                entries.append ((number, updated, offset, length))
+                read = read + 1
+                if len(entries) >= run_size:
+                    runs.append (write_run (entries, directory))
+                    entries = []
+        if len(entries) > 0:
+            runs.append (write_run (entries, directory))
+        entries = None
+        with open (output, "wb") as out:
+            last = None
+            # Entries are sorted by number, then lastUpdated, then offset:
+            # the latest version of a change is the last of its entries.
+            for entry in heapq.merge(*[read_run (run) for run in runs]):
+                if last is not None and last[0] != entry[0]:
+                    written = written + write_line (out, data, last)
+                last = entry
+            if last is not None:
+                written = written + write_line (out, data, last)
+    finally:
+        for run in runs:
+            os.remove (run)
+        if data is not None:
+            data.close()
+    return (read, written)
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    (read, written) = dedup (args.file, args.output, args.run_size)
+    print "Changes read: " + str(read) + ", written: " + str(written) + \
+        " (" + str(read - written) + " repeated)."
@@ -0,0 +1,399 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2014 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Index for JSON files produced by ssh_miner.py (one change per line),
+## for random access to changes.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+
+description = """
+Simple script to index JSON files produced by ssh_miner.py
+(one change per line), so that individual changes can be found
+without reading the whole file.
+
+The index is a sidecar file (same name, with .idx appended), with
+an entry per line: change number, byte offset, length (in bytes),
+and lastUpdated timestamp of the change.
+
+Examples of use:
+
+Build (or rebuild) the index:
+
+dump_index.py /tmp/changes.json
+
+Print change 12345 (latest version found in the file):
+
+dump_index.py --change 12345 /tmp/changes.json
+
+Print byte ranges to split the file in 4 balanced parts:
+
+dump_index.py --split 4 /tmp/changes.json
+
+"""
+
+# Index entry: change number, offset, length, lastUpdated
+ENTRY = struct.Struct("<iqiq")
+
+# Value of an integer (maybe quoted) key in a JSON string
+INT_VALUE = re.compile(r'\s*"?(-?\d+)')
+
+def parse_args ():
+    """
+    Parse command line arguments
+
+    """
+
+    parser = argparse.ArgumentParser(description = description)
+    parser.add_argument("file",
+                        help = "JSON file with the change records, " \
+                            + "as produced by ssh_miner.py."
+                        )
+    parser.add_argument("--change",
+                        help = "Print the latest version of this change.",
+                        type = int
+                        )
+    parser.add_argument("--split",
+                        help = "Print byte ranges to split the file " + \
+                            "in this number of balanced parts.",
+                        type = int
+                        )
+    args = parser.parse_args()
+    return args
+
+def open_map (filename):
+    """Memory map a file, read only.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the file.
+
+    Returns
+    -------
+
+    mmap.mmap: Map of the file (None if the file is empty).
+
+    """
+
+    with open (filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+
+def find_int (data, key, start, end):
+    """Find first key in JSON string, between start and end, return its value.
+
+    The value may be quoted (the gerrit command produces change
+    numbers as strings).
+
+    Parameters
+    ----------
+
+    data: str or mmap.mmap
+        JSON string.
+    key: str
+        Key to find.
+    start: int
+        Offset to start looking at.
+    end: int
+        Offset to stop looking at.
+
+    Returns
+    -------
+
+    int: value for key (None if key was not found).
+
+    """
+
+    found = data.find('"' + key + '":', start, end)
+    if found == -1:
+        return None
+    value_start = found + len(key) + 3
+    match = INT_VALUE.match(data[value_start:min(value_start + 24, end)])
+    if match is None:
+        return None
+    return int(match.group(1))
+
+def scan_lines (data, start = 0, end = None):
+    """Produce index entries for lines (changes) in a JSON string.
+
+    Change number and lastUpdated are found without decoding the line:
+    they are the first "number" and "lastUpdated" keys in it (the gerrit
+    command writes the number before the owner, patchsets and comments).
+    If they cannot be found that way, the line is decoded.
+
+    Parameters
+    ----------
+
+    data: str or mmap.mmap
+        JSON string, one change per line.
+    start: int
+        Offset of the first line to consider (Default: 0).
+    end: int
+        Offset at which to stop (Default: None, means end of data).
+
+    Returns
+    -------
+
+    generator of tuple: (number, offset, length, updated) per line.
+        Length includes the final newline.
+
+    """
+
+    if end is None:
+        end = len(data)
+    offset = start
+    while offset < end:
+        line_end = data.find("\n", offset, end)
+        if line_end == -1:
+            line_end = end
+        else:
+            line_end = line_end + 1
+        if line_end - offset > 1:
+            # Only look for the number before the first nested object
+            # or list, to be sure it is the number of the change
+            nested = [found for found in
+                      (data.find("{", offset + 1, line_end),
+                       data.find("[", offset + 1, line_end))
+                      if found != -1]
+            if len(nested) > 0:
+                number = find_int (data, "number", offset, min(nested))
+            else:
+                number = find_int (data, "number", offset, line_end)
+            updated = find_int (data, "lastUpdated", offset, line_end)
+            if number is None or updated is None:
+                change = json.loads(data[offset:line_end])
+                number = int(change["number"])
+                updated = int(change["lastUpdated"])
+            yield (number, offset, line_end - offset, updated)
+        offset = line_end
+
+def index_filename (filename):
+    """Name of the index file for a JSON file.
+
+    """
+
+    return filename + ".idx"
+
+def build_index (filename):
+    """Build the index for a JSON file, in one pass over the mapped file.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the JSON file (one change per line).
+
+    Returns
+    -------
+
+    int: Number of entries in the index.
+
+    """
+
+    data = open_map (filename)
+    count = 0
+    with open (index_filename (filename), "wb") as index:
+        if data is not None:
+            for entry in scan_lines (data):
+                index.write (ENTRY.pack(*entry))
+                count = count + 1
+            data.close()
+    return count
+
+def read_index (filename):
+    """Read the index for a JSON file, building it if needed.
+
+    The index is (re)built if it does not exist, or if it is older
+    than the JSON file.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the JSON file (one change per line).
+
+    Returns
+    -------
+
+    list of tuple: (number, offset, length, updated), in file order.
+
+    """
+
+    index_name = index_filename (filename)
+    if not os.path.exists(index_name) or \
+            os.path.getmtime(index_name) < os.path.getmtime(filename):
+        build_index (filename)
+    with open (index_name, "rb") as index:
+        raw = index.read()
+    return [ENTRY.unpack_from(raw, offset)
+            for offset in range(0, len(raw), ENTRY.size)]
+
+def latest (entries):
+    """Find the latest version of each change, given index entries.
+
+    The latest version is the one with the highest lastUpdated. If
+    several versions have the same, the one found later in the file.
+
+    Parameters
+    ----------
+
+    entries: list of tuple
+        Index entries (see read_index).
+
+    Returns
+    -------
+
+    dict: (offset, length) of the latest version, by change number.
+
+    """
+
+    found = {}
+    for (number, offset, length, updated) in entries:
+        if number not in found or updated >= found[number][0]:
+            found[number] = (updated, offset, length)
+    return dict([(number, (offset, length))
+                 for number, (updated, offset, length) in found.items()])
+
+def get_change (filename, number, entries = None):
+    """Get the latest version of a change in a JSON file.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the JSON file (one change per line).
+    number: int
+        Change number.
+    entries: list of tuple
+        Index entries (Default: None, means read the index).
+
+    Returns
+    -------
+
+    dict: change, as decoded from the JSON file (None if not found).
+
+    """
+
+    if entries is None:
+        entries = read_index (filename)
+    versions = [(updated, offset, length)
+                for (entry_number, offset, length, updated) in entries
+                if entry_number == number]
+    if len(versions) == 0:
+        return None
+    (updated, offset, length) = max(versions)
+    with open (filename, "rb") as file:
+        file.seek(offset)
+        return json.loads(file.read(length))
+
+def split_ranges (filename, parts):
+    """Split a JSON file in byte ranges of similar size, at line boundaries.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the JSON file (one change per line).
+    parts: int
+        Number of ranges to produce (fewer may be produced for
+        small files).
+
+    Returns
+    -------
+
+    list of tuple: (start, end) byte offsets for each range.
+
+    """
+
+    data = open_map (filename)
+    if data is None:
+        return []
+    size = len(data)
+    ranges = []
+    start = 0
+    for part in range(1, parts + 1):
+        if start >= size:
+            break
+        if part == parts:
+            end = size
+        else:
+            end = data.find("\n", max(size * part / parts, start)) + 1
+            if end == 0:
+                end = size
+        ranges.append ((start, end))
+        start = end
+    data.close()
+    return ranges
+
+def read_range (filename, start, end):
+    """Read the lines (changes) in a byte range of a JSON file.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the JSON file (one change per line).
+    start: int
+        Offset of the first line in the range.
+    end: int
+        Offset of the end of the range (at a line boundary).
+
+    Returns
+    -------
+
+    generator of str: lines in the range.
+
+    """
+
+    with open (filename, "rb") as file:
+        file.seek(start)
+        while file.tell() < end:
+            line = file.readline()
+            if line == "":
+                break
+            yield line
+
+if __name__ == "__main__":
+
+    args = parse_args()
+
+    if args.change is not None:
+        change = get_change (args.file, args.change)
+        if change is None:
+            print "Change not found: " + str(args.change)
+        else:
+            print json.dumps(change, indent = 2)
+    elif args.split is not None:
+        for (start, end) in split_ranges (args.file, args.split):
+            print str(start) + " " + str(end)
+    else:
+        entries = build_index (args.file)
+        print "Index built (" + index_filename (args.file) + "): " + \
+            str(entries) + " entries."
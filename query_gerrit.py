@@ -23,11 +23,10 @@
 ##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
 ##
 
-from grimoirelib_alch.type.timeseries import TimeSeries
-from grimoirelib_alch.type.activity import ActivityList
 from grimoirelib_alch.query.common import GrimoireDatabase, GrimoireQuery
 
 from sqlalchemy import func, Column, Integer, ForeignKey, or_
+from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy.sql import label
 from datetime import datetime
 
@@ -35,6 +34,22 @@ class DB (GrimoireDatabase):
     """Class for dealing with SCM (CVSAnalY) databases.
 
     """
+
+    def __init__(self, url, schema, schema_id = None):
+        """Initialize the database.
+
+        For SQLite databases, url is the url up to the directory
+        with the database file (eg: sqlite:////tmp/), and schema is
+        the name of the file (eg: gerrit.db). Since SQLite has no
+        schemas, tables are found in its "main" database.
+
+        """
+
+        if url.startswith("sqlite"):
+            self.table_schema = "main"
+        else:
+            self.table_schema = schema
+        GrimoireDatabase.__init__(self, url, schema, schema_id)
  
     def _query_cls(self):
         """Return que defauld Query class for this database
@@ -53,72 +68,89 @@ class DB (GrimoireDatabase):
 
         Builds a SQLAlchemy class per SQL table, by using _table().
         It assumes self.Base, self.schema and self.schema_id are already
-        set (see super.__init__() code).
+        set (see super.__init__() code), and self.table_schema too
+        (see __init__() code).
 
         """
 
         DB.Change = GrimoireDatabase._table (
             bases = (self.Base,), name = 'Change',
             tablename = 'changes',
-            schemaname = self.schema,
+            schemaname = self.table_schema,
             columns = dict (
                 owner_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'people.uid')
+                    ForeignKey(self.table_schema + '.' + 'people.uid')
                     ),
                 ))
 
         DB.Message = GrimoireDatabase._table (
             bases = (self.Base,), name = 'Message',
             tablename = 'messages',
-            schemaname = self.schema,
+            schemaname = self.table_schema,
             columns = dict (
                 change_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'changes.uid')
+                    ForeignKey(self.table_schema + '.' + 'changes.uid')
                     ),
                 author_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'people.uid')
+                    ForeignKey(self.table_schema + '.' + 'people.uid')
                     ),
                 ))
 
         DB.Revision = GrimoireDatabase._table (
             bases = (self.Base,), name = 'Revision',
             tablename = 'revisions',
-            schemaname = self.schema,
+            schemaname = self.table_schema,
             columns = dict (
                 change_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'changes.uid')
+                    ForeignKey(self.table_schema + '.' + 'changes.uid')
                     ),
                 author_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'people.uid')
+                    ForeignKey(self.table_schema + '.' + 'people.uid')
                     ),
                 ))
 
         DB.Approval = GrimoireDatabase._table (
             bases = (self.Base,), name = 'Approval',
             tablename = 'approvals',
-            schemaname = self.schema,
+            schemaname = self.table_schema,
             columns = dict (
                 revision_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'revisions.uid')
+                    ForeignKey(self.table_schema + '.' + 'revisions.uid')
                     ),
                 author_id = Column(
                     Integer,
-                    ForeignKey(self.schema + '.' + 'people.uid')
+                    ForeignKey(self.table_schema + '.' + 'people.uid')
                     ),
                 ))
 
         DB.People = GrimoireDatabase._table (
             bases = (self.Base,), name = 'People',
             tablename = 'people',
-            schemaname = self.schema,
+            schemaname = self.table_schema,
             )
 
+        try:
+            DB.MessageBody = GrimoireDatabase._table (
+                bases = (self.Base,), name = 'MessageBody',
+                tablename = 'message_bodies',
+                schemaname = self.table_schema,
+                columns = dict (
+                    message_id = Column(
+                        Integer,
+                        ForeignKey(self.table_schema + '.' + 'messages.uid'),
+                        primary_key = True
+                        ),
+                    ))
+        except NoSuchTableError:
+            # Message bodies are stored in the messages table
+            DB.MessageBody = None
+
 class Query (GrimoireQuery):
     """Class for dealing with Gerrit-related queries"""
 
@@ -0,0 +1,615 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2014 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Package to set up databases for revisor, with the specifics of
+## each supported backend (MySQL, SQLite).
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DataError, IntegrityError
+import sys
+import zlib
+
+# To properly support utf8mb4 in SQLAlchemy
+# http://blog.bbdouglas.com/unicode-surrogate-characters-and-lamp/
+# Important: Create database with (being `revisor_test` the schema name):
+# CREATE SCHEMA `revisor_test` DEFAULT CHARACTER SET utf8mb4 ;
+
+import encodings
+encodings._aliases["utf8mb4"] = "utf_8"
+
+# Pragmas for SQLite connections: write-ahead log, large page cache
+# (negative means KiB), temporary tables in memory, and memory mapped I/O.
+SQLITE_PRAGMAS = [
+    "journal_mode = WAL",
+    "cache_size = -262144",
+    "temp_store = MEMORY",
+    "mmap_size = 268435456",
+    ]
+
+# Milliseconds a loading connection waits for the database to be
+# released by other writers (see revisor_json.py --writers)
+SQLITE_LOAD_TIMEOUT = 600000
+
+def is_sqlite (url):
+    """Find out if url is a SQLAlchemy url for a SQLite database.
+
+    Parameters
+    ----------
+
+    url: str
+        SQLAlchemy url.
+
+    Returns
+    -------
+
+    bool: True if url is for a SQLite database.
+
+    """
+
+    return url.startswith("sqlite")
+
+def set_sqlite_pragmas (target, load = False):
+    """Set pragmas tuned for speed on every new SQLite connection.
+
+    Connections which are not SQLite connections are left untouched,
+    so that target can also be the Engine class (to tune engines
+    built elsewhere, such as those of query_gerrit.DB).
+
+    Parameters
+    ----------
+
+    target: sqlalchemy.engine.Engine (or class)
+        Engine to listen to for new connections.
+    load: bool
+        Connections will be used for loading data: do not wait for
+        data to reach the disk (synchronous = OFF). A crash during
+        the load may corrupt the database, which is fine since
+        loads start from scratch anyway (Default: False). Loads may
+        have several writers, which wait for each other to release
+        the database for as long as needed.
+
+    """
+
+    pragmas = list(SQLITE_PRAGMAS)
+    if load:
+        pragmas.append ("synchronous = OFF")
+        pragmas.append ("busy_timeout = " + str(SQLITE_LOAD_TIMEOUT))
+    else:
+        pragmas.append ("synchronous = NORMAL")
+
+    @event.listens_for(target, "connect")
+    def connect (dbapi_connection, connection_record):
+        if "sqlite" not in type(dbapi_connection).__module__:
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute ("PRAGMA " + pragma)
+        cursor.close()
+
+# Ways of storing message bodies: in the messages table ("inline"),
+# in a separate table ("table"), or in a separate table, compressed
+# with zlib ("zlib").
+MESSAGE_BODIES = ["inline", "table", "zlib"]
+
+def pack_body (text, compress = False):
+    """Pack a message body, to store it in a message bodies table.
+
+    Parameters
+    ----------
+
+    text: unicode
+        Body of the message.
+    compress: bool
+        Compress the body with zlib (Default: False).
+
+    Returns
+    -------
+
+    str: packed body (utf-8 encoded, maybe compressed).
+    bool: True if the body was compressed.
+
+    """
+
+    data = text.encode("utf-8")
+    if compress:
+        return (zlib.compress(data, 6), True)
+    return (data, False)
+
+def unpack_body (data, compressed):
+    """Unpack a message body packed by pack_body.
+
+    Returns
+    -------
+
+    unicode: body of the message.
+
+    """
+
+    if compressed:
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
+
+def set_sqlite_savepoints (engine):
+    """Make savepoints work for SQLite connections of engine.
+
+    The sqlite3 module begins transactions on its own, only before
+    statements modifying data, which breaks SAVEPOINT. Its
+    transaction handling is disabled, and transactions are begun
+    by SQLAlchemy instead. They are begun as writers (IMMEDIATE), so
+    that connections loading at the same time wait for each other
+    (see set_sqlite_pragmas), instead of failing when a reading
+    transaction tries to write.
+
+    Parameters
+    ----------
+
+    engine: sqlalchemy.engine.Engine
+        Engine for a SQLite database.
+
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect (dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin (connection):
+        connection.execute ("BEGIN IMMEDIATE")
+
+def build_engine (url, createdb = False, load = False, echo = False):
+    """Build a SQLAlchemy engine for url, with backend specifics.
+
+    For MySQL, the connection uses the utf8mb4 charset, and the
+    database (schema) is created with it if requested.
+    For SQLite, connections are tuned for speed (see set_sqlite_pragmas),
+    and the database file is created if needed. Engines for loading
+    data support savepoints (see set_sqlite_savepoints, BatchWriter).
+
+    Parameters
+    ----------
+
+    url: str
+        SQLAlchemy url of the database (including schema, if any).
+    createdb: bool
+        Create database if it does not exist (Default: False).
+    load: bool
+        The engine will be used for loading data (Default: False).
+    echo: bool
+        Echo SQL statements (Default: False).
+
+    Returns
+    -------
+
+    sqlalchemy.engine.Engine: engine for the database.
+
+    """
+
+    if is_sqlite(url):
+        engine = create_engine(url, echo=echo)
+        set_sqlite_pragmas (engine, load = load)
+        if load:
+            set_sqlite_savepoints (engine)
+        return engine
+    if createdb:
+        # To create database, we need a SQLAlchemy url for the database
+        # without schema name, since we have to connect to it to create
+        # the schema.
+        (db, schema) = url.rsplit ('/', 1)
+        dbengine = create_engine(db, echo=False, encoding='utf8mb4')
+        dbengine.execute ("CREATE DATABASE IF NOT EXISTS " + schema \
+                            + " DEFAULT CHARACTER SET utf8mb4")
+#    trailer = "?charset=utf8&use_unicode=0"
+    trailer = "?charset=utf8mb4&use_unicode=0"
+    return create_engine(url + trailer, echo=echo, encoding='utf8mb4')
+
+class BadRecord (ValueError):
+    """Bad data in an item, found before producing records for it.
+
+    Raised when checking data (eg, a JSON document, see check_record),
+    before adding records to a session, counting rows or changing any
+    other state, so that BatchWriter can reject the item without
+    rolling back the items produced with it.
+
+    """
+
+def of_type (kind):
+    """Function checking that a value is of some type (see check_record).
+
+    Parameters
+    ----------
+
+    kind: type or tuple of types
+        Types accepted.
+
+    Returns
+    -------
+
+    callable: function raising TypeError for values of other types.
+
+    """
+
+    def check (value):
+        if not isinstance (value, kind):
+            raise TypeError ("not " + getattr(kind, "__name__", str(kind)))
+    return check
+
+def check_record (record, fields, what):
+    """Check that a record (dictionary, from a JSON document) has fields.
+
+    Parameters
+    ----------
+
+    record: dict
+        Record to check.
+    fields: dict
+        For each field the record has to have, function to check its
+        value, raising TypeError or ValueError if it is not valid
+        (eg, int), or None to accept any value.
+    what: str
+        Name of the record, for errors.
+
+    Raises
+    ------
+
+    BadRecord: if record is not a dictionary, or a field is missing,
+        or has a value which is not valid.
+
+    """
+
+    if not isinstance (record, dict):
+        raise BadRecord (what + ": not an object")
+    for (field, check) in fields.iteritems():
+        if field not in record:
+            raise BadRecord (what + ": no " + field)
+        if check is None:
+            continue
+        try:
+            check (record[field])
+        except (TypeError, ValueError):
+            raise BadRecord (what + ": bad " + field + ": " +
+                             repr(record[field])[:80])
+
+# Errors caused by bad data in an item, which make BatchWriter reject
+# it (instead of aborting the load). Other errors (eg, KeyError from
+# a bug producing records) abort the load.
+RECORD_ERRORS = (BadRecord, DataError, IntegrityError)
+
+class BatchWriter (object):
+    """Writer of items (records) to a session, committing them in batches.
+
+    Records for each item (eg, a change, with its messages, revisions,
+    etc.) are produced by a function, which adds them to the session.
+    Items are produced and flushed in groups, each in a savepoint. If
+    a group fails because of bad data in an item, found by the database
+    (eg, a value too long for its column, or a duplicated key), the
+    group is rolled back and its items are produced again, in halves
+    of it, each in its own savepoint, splitting again those that fail
+    (see bisect), so that only the bad item is rolled back, and written
+    to a file of rejects, while the rest of the batch is kept. If bad
+    data is found before producing records (see BadRecord), the item
+    is rejected without rolling back the group. Other errors abort
+    the load. Items are committed when batch items, or batch_bytes
+    bytes of their source, are pending (see checkpoint).
+
+    Since items may be produced again, functions producing them
+    should not have effects other than adding records to the session,
+    counting rows (counts are held until items are written, see
+    Telemetry.hold), and changing state which can be restored when
+    savepoints are rolled back (see state, in __init__).
+    For SQLite, the engine of the session has to support savepoints
+    (see build_engine, with load = True).
+
+    """
+
+    def __init__ (self, session, batch = 1000, batch_bytes = 0,
+                  rejects = None, telemetry = None, group = 100,
+                  state = None):
+        """Initialize the writer.
+
+        Parameters
+        ----------
+
+        session: sqlalchemy.orm.Session
+            Session to write to.
+        batch: int
+            Items to commit at a time (Default: 1000, 0 means no limit).
+        batch_bytes: int
+            Bytes of source of items to commit at a time
+            (Default: 0, means no limit).
+        rejects: str
+            File to append the source of rejected items to, one per
+            line (Default: None, means rejected items are only reported).
+        telemetry: telemetry.Telemetry
+            Instrumentation, to account for commits and rejected items
+            (Default: None).
+        group: int
+            Items to produce in the same savepoint (Default: 100).
+        state: object
+            State changed when producing items, other than the session
+            (eg, caches of records), with methods save (to keep the
+            current state as the one to go back to) and restore (to go
+            back to it), called when savepoints begin and are rolled
+            back (Default: None).
+
+        """
+
+        self.session = session
+        self.batch = batch
+        self.batch_bytes = batch_bytes
+        self.rejects = rejects
+        self.rejects_file = None
+        self.telemetry = telemetry
+        self.group = group
+        self.state = state
+        self.items = []
+        self.items_bytes = 0
+        self.savepoint = None
+        self.pending = 0
+        self.pending_bytes = 0
+        self.written = 0
+        self.rejected = 0
+
+    def write (self, produce, source, size = None):
+        """Produce records for an item, in the savepoint of the current group.
+
+        Parameters
+        ----------
+
+        produce: callable
+            Function (with no arguments) producing the records for the
+            item, and adding them to the session.
+        source: str
+            Source of the item (eg, a line of a JSON document), written
+            to the rejects file if the item is rejected.
+        size: int
+            Bytes of the item (Default: None, means length of source).
+
+        """
+
+        if size is None:
+            size = len(source)
+        if self.savepoint is None:
+            self.begin ()
+            self.savepoint = self.session.begin_nested()
+        self.items.append ((produce, source, size))
+        self.items_bytes = self.items_bytes + size
+        try:
+            produce ()
+        except BadRecord as error:
+            # Nothing was produced for the item (see BadRecord)
+            self.items.pop ()
+            self.items_bytes = self.items_bytes - size
+            self.reject (source, error)
+            return
+        except RECORD_ERRORS as error:
+            self.isolate (error)
+            return
+        if len(self.items) >= self.group:
+            self.flush ()
+
+    def flush (self):
+        """Flush the items of the current group, and close its savepoint.
+
+        Should be called before using the session for anything else
+        than producing items, so that it is not done again if items
+        are produced again.
+
+        """
+
+        if self.savepoint is None:
+            return
+        try:
+            self.savepoint.commit()
+        except RECORD_ERRORS as error:
+            self.isolate (error)
+            return
+        self.end ()
+        self.done (self.items)
+        (self.items, self.items_bytes, self.savepoint) = ([], 0, None)
+
+    def isolate (self, error):
+        """Roll back the current group, and write its items again (see bisect).
+
+        Parameters
+        ----------
+
+        error: Exception
+            Error that made the group fail.
+
+        """
+
+        self.savepoint.rollback()
+        self.end (rollback = True)
+        items = self.items
+        (self.items, self.items_bytes, self.savepoint) = ([], 0, None)
+        if len(items) == 1:
+            self.reject (items[0][1], error)
+        else:
+            self.bisect (items)
+
+    def bisect (self, items):
+        """Write again items that failed together, rejecting bad ones.
+
+        Items are split in halves, each written in its own savepoint.
+        If the first half is written, the failure is in the second
+        one, which is split again without writing it first. A half
+        that fails is split again, until bad items, alone, are rejected.
+        This way, a bad item in a group of n items needs about 2 * log2(n)
+        savepoints, instead of n.
+
+        Parameters
+        ----------
+
+        items: list of tuple
+            Items (see write), at least two.
+
+        """
+
+        half = len(items) // 2
+        (first, second) = (items[:half], items[half:])
+        if self.replay (first) and len(second) > 1:
+            self.bisect (second)
+        else:
+            self.replay (second)
+
+    def replay (self, items):
+        """Produce items again, in a savepoint of their own.
+
+        If they fail, and they are several, they are split (see bisect),
+        else the item is rejected.
+
+        Parameters
+        ----------
+
+        items: list of tuple
+            Items (see write).
+
+        Returns
+        -------
+
+        bool: True if all items were written in the savepoint.
+
+        """
+
+        self.begin ()
+        try:
+            with self.session.begin_nested():
+                for (produce, source, size) in items:
+                    produce ()
+        except RECORD_ERRORS as error:
+            self.end (rollback = True)
+            if len(items) == 1:
+                self.reject (items[0][1], error)
+            else:
+                self.bisect (items)
+            return False
+        self.end ()
+        self.done (items)
+        return True
+
+    def begin (self):
+        """Hold counts and save state, before producing items in a savepoint.
+
+        """
+
+        if self.telemetry is not None:
+            self.telemetry.hold ()
+        if self.state is not None:
+            self.state.save ()
+
+    def end (self, rollback = False):
+        """Count held counts, or discard them and restore state (see begin).
+
+        Parameters
+        ----------
+
+        rollback: bool
+            The savepoint was rolled back (Default: False).
+
+        """
+
+        if self.telemetry is not None:
+            self.telemetry.release (discard = rollback)
+        if self.state is not None and rollback:
+            self.state.restore ()
+
+    def done (self, items):
+        """Account for items written.
+
+        """
+
+        self.written = self.written + len(items)
+        self.pending = self.pending + len(items)
+        self.pending_bytes = self.pending_bytes + \
+            sum([size for (produce, source, size) in items])
+
+    def reject (self, source, error):
+        """Report a rejected item, and append its source to the rejects file.
+
+        """
+
+        self.rejected = self.rejected + 1
+        if self.telemetry is not None:
+            self.telemetry.count ("rejected")
+        sys.stderr.write ("Rejected item (" + type(error).__name__ + \
+                              ": " + str(error).splitlines()[0][:200] + \
+                              ")\n")
+        if self.rejects is None:
+            return
+        if self.rejects_file is None:
+            self.rejects_file = open (self.rejects, "a")
+        if not source.endswith("\n"):
+            source = source + "\n"
+        self.rejects_file.write (source)
+
+    def checkpoint (self):
+        """Commit pending items, if there are enough of them (see batch).
+
+        Items in the current group are considered as pending.
+
+        Returns
+        -------
+
+        bool: True if items were committed.
+
+        """
+
+        pending = self.pending + len(self.items)
+        pending_bytes = self.pending_bytes + self.items_bytes
+        if (self.batch > 0 and pending >= self.batch) or \
+                (self.batch_bytes > 0 and
+                 pending_bytes >= self.batch_bytes):
+            self.commit ()
+            return True
+        return False
+
+    def commit (self):
+        """Commit pending items (flushing the current group first).
+
+        """
+
+        self.flush ()
+        if self.telemetry is not None:
+            with self.telemetry.stage("commit"):
+                self.session.commit()
+        else:
+            self.session.commit()
+        self.pending = 0
+        self.pending_bytes = 0
+
+    def finish (self):
+        """Commit pending items, and close the rejects file.
+
+        Returns
+        -------
+
+        int: Number of items written.
+        int: Number of items rejected.
+
+        """
+
+        self.commit ()
+        if self.rejects_file is not None:
+            self.rejects_file.close()
+            self.rejects_file = None
+        return (self.written, self.rejected)
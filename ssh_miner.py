@@ -25,8 +25,18 @@
 
 import argparse
 from subprocess import check_output, CalledProcessError
-from time import sleep
+from time import sleep, time
 import json
+import os
+import random
+import threading
+import Queue
+from datetime import datetime, timedelta
+
+from dedup_dump import dedup
+from dump_index import find_int
+
+from telemetry import Telemetry
 
 description = """
 Simple script to retrieve data from Gerrit systems via ssh.
@@ -39,8 +49,39 @@ Example of execution:
 
 ssh_miner.py --projectlist wikimedia_projects.json gerrit.wikimedia.org 29418 /tmp/changes.json
 
+Queries are retrieved in pages (using the limit: operator), whose size
+adapts to the time queries take. Several queries (for several status
+or projects) can be run at the same time with --workers, while
+--max_concurrency caps the number of queries running at the same time
+in the Gerrit server:
+
+ssh_miner.py --projectlist wikimedia_projects.json --workers 8 --max_concurrency 4 gerrit.wikimedia.org 29418 /tmp/changes.json
+
+A single huge project (or status) can be split in time slices (by
+date of last update, using the after: and before: operators), which
+are retrieved at the same time and then stitched together, with no
+repeated changes:
+
+ssh_miner.py --projectlist core.json --slices 16 --workers 8 gerrit.wikimedia.org 29418 /tmp/changes.json
+
+With --state, the newest update date found for each status or project
+query is kept in a state file, and later runs only retrieve changes
+updated since then. The resulting file can be loaded with
+revisor_json.py --incremental:
+
+ssh_miner.py --status merged,abandoned,open --state /tmp/state.json gerrit.wikimedia.org 29418 /tmp/delta.json
+
+With --database, changes are loaded in a database (as revisor_json.py
+does) while they are retrieved, with no need of an intermediate file
+(which is still written if specified):
+
+ssh_miner.py --status merged,abandoned,open --database sqlite:////tmp/gerrit_changes.db gerrit.wikimedia.org 29418
+
 """
 
+# Instrumentation for the retrieval
+telemetry = Telemetry("ssh_miner")
+
 def parse_args ():
     """
     Parse command line arguments
@@ -54,12 +95,14 @@ def parse_args ():
     parser.add_argument("port",
                         help = "Gerrit port to be accessed via ssh"
                         )
-    parser.add_argument("file",
-                        help = "File to write the resulting JSON document"
+    parser.add_argument("file", nargs = "?",
+                        help = "File to write the resulting JSON document" + \
+                            " (optional with --database)"
                         )
     parser.add_argument("--sortkey",
                         help = "Sortkey to resume retrieval " + \
-                            "(usually needs --status too)."
+                            "(usually needs --status too, " + \
+                            "not compatible with --slices)."
                         )
     parser.add_argument("--status",
                         help = "Status of changes to retrieve, separated by commas, such as 'merged,abandoned,open'."
@@ -67,7 +110,135 @@ def parse_args ():
     parser.add_argument("--projectlist",
                         help = "List of strings, in JSON format, with projects to retrieve changes from."
                         )
+    parser.add_argument("--workers",
+                        help = "Number of queries (status or projects) " + \
+                            "to retrieve at the same time (default: 1).",
+                        type = int, default = 1
+                        )
+    parser.add_argument("--max_concurrency",
+                        help = "Maximum number of queries running " + \
+                            "at the same time in the server (default: 4).",
+                        type = int, default = 4
+                        )
+    parser.add_argument("--limit",
+                        help = "Initial number of changes per page " + \
+                            "(default: 250).",
+                        type = int, default = 250
+                        )
+    parser.add_argument("--max_limit",
+                        help = "Maximum number of changes per page " + \
+                            "(default: 500).",
+                        type = int, default = 500
+                        )
+    parser.add_argument("--target",
+                        help = "Target time for retrieving a page, " + \
+                            "in seconds (default: 20).",
+                        type = float, default = 20.0
+                        )
+    parser.add_argument("--slices",
+                        help = "Split each status or project query " + \
+                            "in this number of time slices.",
+                        type = int
+                        )
+    parser.add_argument("--since",
+                        help = "Start of the first time slice, " + \
+                            "in format 2014-10-29 (default: 2009-01-01).",
+                        default = "2009-01-01"
+                        )
+    parser.add_argument("--until",
+                        help = "End of the last time slice, " + \
+                            "in format 2014-10-29 (default: today).",
+                        )
+    parser.add_argument("--state",
+                        help = "State file (JSON) with the newest " + \
+                            "update found per query, to retrieve only " + \
+                            "changes updated since last run."
+                        )
+    parser.add_argument("--project_stats",
+                        help = "File (JSON) with number of changes per " + \
+                            "project found in previous runs, used to " + \
+                            "plan chuncks of projects (updated after " + \
+                            "each run). Projects not in it are counted " + \
+                            "with cheap queries."
+                        )
+    parser.add_argument("--chunck_changes",
+                        help = "Changes for a project to be retrieved " + \
+                            "on its own, and maximum changes for a " + \
+                            "chunck of smaller projects (default: 1000).",
+                        type = int, default = 1000
+                        )
+    parser.add_argument("--chunck_projects",
+                        help = "Maximum projects in a chunck " + \
+                            "(default: 50).",
+                        type = int, default = 50
+                        )
+    parser.add_argument("--database",
+                        help = "SQLAlchemy url of a database to load " + \
+                            "changes to while retrieving them " + \
+                            "(as revisor_json.py does)."
+                        )
+    parser.add_argument("--createdb",
+                        help = "Create database if it does not exist " + \
+                            "(with --database).",
+                        action = "store_true"
+                        )
+    parser.add_argument("--deferred",
+                        help = "Create bare tables, and build indexes " + \
+                            "and foreign keys after loading the data " + \
+                            "(with --database).",
+                        action = "store_true"
+                        )
+    parser.add_argument("--incremental",
+                        help = "Add changes to an existing database, " + \
+                            "replacing those already in it " + \
+                            "(with --database).",
+                        action = "store_true"
+                        )
+    parser.add_argument("--message_bodies",
+                        help = "Where to store message bodies: " + \
+                            "inline, table or zlib (with --database, " + \
+                            "see revisor_json.py) (default: inline).",
+                        choices = ["inline", "table", "zlib"],
+                        default = "inline"
+                        )
+    parser.add_argument("--queue_size",
+                        help = "Maximum number of pages retrieved " + \
+                            "and waiting to be loaded (default: 8).",
+                        type = int, default = 8
+                        )
+    parser.add_argument("--batch",
+                        help = "Changes to commit at a time, when " + \
+                            "loading to a database (default: 1000, " + \
+                            "0 means no limit).",
+                        type = int, default = 1000
+                        )
+    parser.add_argument("--batch_bytes",
+                        help = "Bytes (of JSON) of changes to commit " + \
+                            "at a time, when loading to a database " + \
+                            "(default: 0, means no limit).",
+                        type = int, default = 0
+                        )
+    parser.add_argument("--rejects",
+                        help = "File to append changes that could not " + \
+                            "be loaded to a database to (one per line) " + \
+                            "(default: only report them)."
+                        )
+    parser.add_argument("--stats",
+                        help = "File to write a summary (JSON) of " + \
+                            "time per stage and records retrieved to " + \
+                            "(default: write it to stderr). With " + \
+                            "--database, the summary of the load is " + \
+                            "written to the same name plus .load."
+                        )
     args = parser.parse_args()
+    if args.file is None and args.database is None:
+        parser.error ("a file, or --database, is needed.")
+    if args.incremental and args.deferred:
+        parser.error ("--incremental and --deferred are not compatible.")
+    if args.slices and args.sortkey:
+        parser.error ("--slices and --sortkey are not compatible " +
+                      "(a sortkey is only valid for the query it " +
+                      "was found in).")
     return args
 
 def find_last_str (string, key):
@@ -79,6 +250,15 @@ def find_last_str (string, key):
     value = string[start+len(key)+4:end]
     return value
 
+def find_str (string, key):
+    """Find first key in JSON string, and return its value (string).
+
+    """
+    start = string.find('"' + key + '":"')
+    end = string.find('","', start)
+    value = string[start+len(key)+4:end]
+    return value
+
 def find_last_int (string, key):
     """Find last key in JSON string, and return its value (integer).
 
@@ -88,116 +268,754 @@ def find_last_int (string, key):
     value = string[start+len(key)+3:end]
     return int(value)
 
-def retrieve (file, base_command, records, sortkey = None):
-    """Retrieve changes according to status_command, including retries.
+def stream_key (query):
+    """Key for a stream, for keeping its state across runs.
+
+    The key is the query, excluding time slice terms (see time_slices)
+    and since terms (see since_query), so that all slices of a query
+    share the same key.
+
+    Parameters
+    ----------
+
+    query: list of str
+        Terms of the query for the stream.
+
+    Returns
+    -------
+
+    str: key.
+
+    """
+
+    return " ".join([term for term in query
+                     if not (term.startswith("after:") \
+                                 or term.startswith("before:"))])
+
+def read_state (filename):
+    """Read the state file, with the newest update found per stream key.
 
     Parameters
     ----------
 
-    file: file
-       File to write retrieved records to.
-    base_command: list of str
-       Arguments of base command to retrieve Gerrit records.
-    records: int
-       Number of records retrieved so far.
-    sortkey: str
-       sortkey used by gerrit to resume a retrieval.
+    filename: str
+        Name of the state file (JSON).
 
     Returns
     -------
 
-    int: Number of retrieved records, counting from records up.
+    dict: newest lastUpdated (timestamp) by stream key (empty if the
+        state file does not exist).
 
     """
 
-    complete = False
-    read_records = records
-    while not complete:
-        if sortkey is None:
-            command = base_command
+    if not os.path.exists(filename):
+        return {}
+    with open (filename, "r") as state_file:
+        return json.loads(state_file.read())
+
+def write_state (filename, state, engine):
+    """Update the state file with what was found by an engine.
+
+    Streams which failed keep their previous state, so that next
+    run retrieves again their changes. State is kept by stream key,
+    and also by project ("project:" + name), for those projects in
+    streams which were completed, unless they are also in a stream
+    which failed (eg, another time slice for the same project).
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the state file (JSON).
+    state: dict
+        Previous state (see read_state).
+    engine: Engine
+        Engine with the newest update found per stream key.
+
+    """
+
+    for key, newest in engine.newest.items():
+        if key not in engine.failed and newest > state.get(key, 0):
+            state[key] = newest
+    # State by project, for queries with chuncks of projects (chuncks
+    # may change from run to run). Projects with no changes found are
+    # known to have no changes updated before the engine started.
+    for project in engine.completed - engine.failed_projects:
+        key = "project:" + project
+        if project in engine.project_newest:
+            newest = engine.project_newest[project]
         else:
-            command = base_command + ["resume_sortkey:" + sortkey,]
-        retrieved = False
-        # Run up to five times if it fails.
-        for n in xrange(5):
+            newest = int(engine.started)
+        if newest > state.get(key, 0):
+            state[key] = newest
+    with open (filename + ".tmp", "w") as state_file:
+        state_file.write (json.dumps(state, indent = 2, sort_keys = True))
+    os.rename (filename + ".tmp", filename)
+
+def since_query (query, state):
+    """Add terms to a query, to retrieve only changes updated since last run.
+
+    Parameters
+    ----------
+
+    query: list of str
+        Terms of the query for a stream.
+    state: dict
+        State, with the newest update found per stream key.
+
+    Returns
+    -------
+
+    list of str: terms of the query, with an after: term if the query
+        is in state, or if all its projects are. Since after: has day
+        granularity, changes updated the same day as the newest one
+        will be retrieved again.
+
+    """
+
+    key = stream_key (query)
+    projects = [term for term in query if term.startswith("project:")]
+    if key in state:
+        newest = state[key]
+    elif len(projects) > 0 and \
+            all([project in state for project in projects]):
+        newest = min([state[project] for project in projects])
+    else:
+        return query
+    newest = datetime.utcfromtimestamp(newest)
+    return query + ["after:" + newest.strftime("%Y-%m-%d")]
+
+def backoff_delay (attempt, base = 3, cap = 300):
+    """Delay before retrying, with jittered exponential backoff.
+
+    The delay is random, between zero and base * 2^attempt seconds
+    (but no longer than cap), so that failing streams do not retry
+    all at the same time.
+
+    Parameters
+    ----------
+
+    attempt: int
+        Number of attempts that failed so far, minus one.
+    base: float
+        Base delay, in seconds (Default: 3).
+    cap: float
+        Maximum delay, in seconds (Default: 300).
+
+    Returns
+    -------
+
+    float: seconds to wait.
+
+    """
+
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class PageSizer (object):
+    """Adaptive page size (limit: operator) for a stream of queries.
+
+    Page size grows while queries are fast and succeed, and shrinks
+    when they are slow or fail, so that each query takes about target
+    seconds. Error rate is tracked as an exponentially weighted
+    moving average.
+
+    """
+
+    def __init__ (self, size = 250, minimum = 25, maximum = 500,
+                  target = 20.0):
+        """Initialize the page sizer.
+
+        Parameters
+        ----------
+
+        size: int
+            Initial page size (Default: 250).
+        minimum: int
+            Minimum page size (Default: 25).
+        maximum: int
+            Maximum page size (Default: 500, the default maximum
+            for queries in Gerrit).
+        target: float
+            Target time per query, in seconds (Default: 20).
+
+        """
+
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.error_rate = 0.0
+
+    def success (self, seconds):
+        """Adapt page size after a successful query.
+
+        Parameters
+        ----------
+
+        seconds: float
+            Time the query took.
+
+        """
+
+        self.error_rate = self.error_rate * 0.8
+        if seconds > self.target:
+            self.size = int(self.size * 0.75)
+        elif seconds < self.target / 2 and self.error_rate < 0.1:
+            self.size = int(self.size * 1.25) + 1
+        self.size = max(self.minimum, min(self.maximum, self.size))
+
+    def failure (self):
+        """Adapt page size after a failed query.
+
+        """
+
+        self.error_rate = self.error_rate * 0.8 + 0.2
+        self.size = max(self.minimum, self.size / 2)
+
+class Engine (object):
+    """Engine to run streams of queries to Gerrit concurrently.
+
+    A stream is a query retrieved page after page, resuming each page
+    with the sortkey of the last change in the previous one. Streams
+    are run by a pool of worker threads (each query is an ssh
+    subprocess), and the number of queries running at the same time
+    is capped, to keep load on the Gerrit server bounded. Pages are
+    written to a file as a whole, so that lines of different streams
+    are never mixed, and/or put in the queue of a loader (see
+    revisor_json.Loader), which loads them in a database while
+    retrieval goes on.
+
+    """
+
+    def __init__ (self, file, base_command, workers = 1, max_concurrency = 4,
+                  limit = 250, max_limit = 500, target = 20.0,
+                  retries = 5, loader = None):
+        """Initialize the engine.
+
+        Parameters
+        ----------
+
+        file: file
+            File to write retrieved records to (None for no file).
+        base_command: list of str
+            Arguments of base command to retrieve Gerrit records.
+        workers: int
+            Number of streams to run at the same time (Default: 1).
+        max_concurrency: int
+            Maximum number of queries running at the same time
+            (Default: 4).
+        limit: int
+            Initial page size for each stream (Default: 250).
+        max_limit: int
+            Maximum page size (Default: 500).
+        target: float
+            Target time per query, in seconds (Default: 20).
+        retries: int
+            Number of times to run a query before giving up
+            (Default: 5).
+        loader: revisor_json.Loader
+            Loader to put retrieved records in (Default: None,
+            means no loader).
+
+        """
+
+        self.file = file
+        self.base_command = base_command
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.max_limit = max_limit
+        self.target = target
+        self.retries = retries
+        self.loader = loader
+        self.records = 0
+        # Newest lastUpdated found, and streams that failed, by stream key
+        self.newest = {}
+        self.failed = set()
+        # Changes found, and newest lastUpdated found, by project
+        self.projects = {}
+        self.project_newest = {}
+        # Projects in streams which were completed, and which failed
+        self.completed = set()
+        self.failed_projects = set()
+        self.started = time()
+
+    def query (self, command, sizer):
+        """Run a query, with retries.
+
+        Parameters
+        ----------
+
+        command: list of str
+            Command to run.
+        sizer: PageSizer
+            Page sizer for the stream, informed of results.
+
+        Returns
+        -------
+
+        str: output of the query (None if it failed after all retries).
+
+        """
+
+        for attempt in xrange(self.retries):
             try:
-                #print " ".join(command)
-                output = check_output(command)
-                retrieved = True
-                #print output
-                break
+                with self.slots:
+                    started = time()
+                    with telemetry.stage("fetch"):
+                        output = check_output(command)
+                sizer.success (time() - started)
+                return output
             except CalledProcessError:
-                sleep (6 * (n+2))
-                print "Retrying...."
-        if not retrieved:
-            break
+                telemetry.count ("retries")
+                sizer.failure ()
+                sleep (backoff_delay (attempt))
+        return None
+
+    def write (self, output, key):
+        """Write the changes in the output of a query (not its stats line).
+
+        Parameters
+        ----------
+
+        output: str
+            Output of a query.
+        key: str
+            Key of the stream (see stream_key).
+
+        """
+
+        # Find last newline (before the final newline) 
+        last_nl = output.rfind("\n", 0, -1)
+        newest = None
+        projects = {}
+        lines = output[0:last_nl+1].splitlines()
+        for line in lines:
+            updated = find_int (line, "lastUpdated", 0, len(line))
+            if updated is not None and (newest is None or updated > newest):
+                newest = updated
+            project = find_str (line, "project")
+            (changes, project_newest) = projects.get(project, (0, 0))
+            projects[project] = (changes + 1, max(project_newest, updated))
+        # Load everything except for the last line (waits if the
+        # loader is behind). Pages of a stream are loaded in order,
+        # since a stream is retrieved by a single worker.
+        if self.loader is not None:
+            self.loader.put (lines)
+        # Write everything except for the last line
+        with self.lock:
+            if self.file is not None:
+                with telemetry.stage("write"):
+                    self.file.write (output[0:last_nl+1])
+            if newest is not None and newest > self.newest.get(key, 0):
+                self.newest[key] = newest
+            for project, (changes, newest) in projects.items():
+                self.projects[project] = \
+                    self.projects.get(project, 0) + changes
+                if newest > self.project_newest.get(project, 0):
+                    self.project_newest[project] = newest
+
+    def retrieve (self, query, sortkey = None):
+        """Retrieve changes for a stream, page after page.
+
+        Parameters
+        ----------
+
+        query: list of str
+           Terms of the query for the stream (eg: ["status:open"]).
+        sortkey: str
+           sortkey used by gerrit to resume a retrieval.
+
+        Returns
+        -------
+
+        int: Number of retrieved records.
+
+        """
+
+        sizer = PageSizer(size = self.limit, maximum = self.max_limit,
+                          target = self.target)
+        key = stream_key (query)
+        read_records = 0
+        complete = False
+        while not complete:
+            command = self.base_command + query \
+                + ["limit:" + str(sizer.size)]
+            if sortkey is not None:
+                command = command + ["resume_sortkey:" + sortkey,]
+            output = self.query (command, sizer)
+            if output is None:
+                print "Giving up: " + " ".join(query)
+                with self.lock:
+                    self.failed.add (key)
+                    self.failed_projects.update (
+                        [term[8:] for term in query
+                         if term.startswith("project:")])
+                break
+            rows = find_last_int (output, "rowCount")
+            if rows > 0:
+                read_records = read_records + rows
+                telemetry.count ("changes", rows)
+                telemetry.count ("pages")
+                sortkey = find_last_str (output, "sortKey")
+                self.write (output, key)
+                with self.lock:
+                    self.records = self.records + rows
+                    telemetry.progress()
+            # Newer Gerrit versions tell when there are no more changes,
+            # which saves a last query with no results
+            if rows == 0 or '"moreChanges":false' in output[-200:]:
+                complete = True
+                with self.lock:
+                    self.completed.update ([term[8:] for term in query
+                                            if term.startswith("project:")])
+        return read_records
+
+    def run (self, streams):
+        """Run streams, using the pool of workers.
+
+        Parameters
+        ----------
+
+        streams: list of (list of str, str)
+            Streams to run, as (query, sortkey) (sortkey can be None).
+            See retrieve.
+
+        Returns
+        -------
+
+        int: Number of retrieved records, for all streams.
+
+        """
+
+        pending = Queue.Queue()
+        for stream in streams:
+            pending.put (stream)
+
+        def worker ():
+            while True:
+                try:
+                    (query, sortkey) = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                print "Stream: " + " ".join(query) + "."
+                self.retrieve (query, sortkey)
+
+        threads = [threading.Thread(target = worker)
+                   for count in range(min(self.workers, len(streams)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with timeout, so that the main thread can be interrupted
+            while thread.is_alive():
+                thread.join(1)
+        return self.records
+
+def or_query (projects):
+    """Produce query terms for changes in any of several projects.
+
+    Parameters
+    ----------
+
+    projects: list of str
+       Projects to be retrieved.
+
+    Returns
+    -------
+
+    list of str: query terms (parenthesized if there are several projects).
+
+    """
+
+    query = ["project:" + item for item in projects]
+    or_query = []
+    for project in query:
+        or_query.extend([project, "OR"])
+    or_query.pop()
+    if len(query) > 1:
+        or_query = ["("] + or_query + [")"]
+    return or_query
+
+def count_changes (engine, command, projects, cap = 500, batch = 50):
+    """Count changes per project, with cheap queries.
+
+    Queries ask for no details (no patchsets, comments, etc.), and for
+    several projects at once (up to batch projects). When a query
+    reaches cap changes (or the server says there are more), its
+    projects are split in two halves, which are counted separately.
+    Projects reaching cap on their own, and projects which could not
+    be counted, are counted as having infinite changes, so that they
+    are always considered large (see plan_projects).
+
+    Parameters
+    ----------
+
+    engine: Engine
+       Engine to run queries (with its retries and concurrency cap).
+    command: list of str
+       Arguments of command to run cheap queries.
+    projects: list of str
+       Projects to count changes for.
+    cap: int
+       Maximum changes per query (Default: 500).
+    batch: int
+       Maximum projects per query (Default: 50).
+
+    Returns
+    -------
+
+    dict: number of changes by project (float("inf") if unknown).
+
+    """
+
+    counts = {}
+    pending = [projects[i:i + batch] for i in range(0, len(projects), batch)]
+    while len(pending) > 0:
+        chunck = pending.pop()
+        output = engine.query (command + or_query (chunck) \
+                                   + ["limit:" + str(cap)], PageSizer())
+        telemetry.count ("probes")
+        if output is None:
+            # Unknown: consider them large
+            for project in chunck:
+                counts[project] = float("inf")
+            continue
         rows = find_last_int (output, "rowCount")
-        if rows > 0:
-            read_records = read_records + rows
-            print "Records read: " + str(read_records) + "."
-            sortkey = find_last_str (output, "sortKey")
-            # Find last newline (before the final newline) 
-            last_nl = output.rfind("\n", 0, -1)
-            # Write everything except for the last line
-            file.write (output[0:last_nl+1])
-        else:
-            complete = True
-    return read_records
+        # Servers may return fewer changes than asked for, but then
+        # they tell that there are more
+        capped = rows >= cap or '"moreChanges":true' in output[-200:]
+        if capped and len(chunck) > 1:
+            half = len(chunck) / 2
+            pending.extend ([chunck[:half], chunck[half:]])
+            continue
+        if capped:
+            counts[chunck[0]] = float("inf")
+            continue
+        for project in chunck:
+            counts[project] = 0
+        for line in output.splitlines()[:-1]:
+            project = json.loads(line)["project"]
+            counts[project] = counts.get(project, 0) + 1
+    return counts
 
-def retrieve_projects (file, base_command, records, projects, size = 1):
-    """Retrieve changes for several projects, in chuncks.
+def plan_projects (projects, counts, chunck_changes = 1000,
+                   chunck_projects = 50):
+    """Plan chuncks of projects to retrieve, based on their changes.
+
+    Projects with at least chunck_changes changes get a chunck of their
+    own. Smaller projects are packed (first fit, largest first) in
+    chuncks with up to chunck_changes changes and up to chunck_projects
+    projects. Chuncks are returned largest first, so that workers
+    taking them in order end up with balanced work.
 
     Parameters
     ----------
 
-    file: file
-       File to write retrieved records to.
-    base_command: list of str
-       Arguments of base command to retrieve Gerrit records.
-    records: int
-       Number of records retrieved so far.
     projects: list of str
        Projects to be retrieved.
-    size: int
-       Size of chuncks (to split projects list).
+    counts: dict
+       Estimated number of changes by project (see count_changes).
+    chunck_changes: int
+       Changes for a project to be considered large, and maximum
+       changes in a chunck of small projects (Default: 1000).
+    chunck_projects: int
+       Maximum projects in a chunck (Default: 50).
+
+    Returns
+    -------
+
+    list of (int, list of str): chuncks, as (estimated changes, projects).
+
+    """
+
+    large = [(counts[project], [project]) for project in projects
+             if counts[project] >= chunck_changes]
+    small = sorted ([project for project in projects
+                     if counts[project] < chunck_changes],
+                    key = lambda project: counts[project], reverse = True)
+    chuncks = []
+    for project in small:
+        for chunck in chuncks:
+            if chunck[0] + counts[project] <= chunck_changes and \
+                    len(chunck[1]) < chunck_projects:
+                chunck[0] = chunck[0] + counts[project]
+                chunck[1].append (project)
+                break
+        else:
+            chuncks.append ([counts[project], [project]])
+    plan = large + [(changes, chunck) for (changes, chunck) in chuncks]
+    plan.sort (key = lambda chunck: chunck[0], reverse = True)
+    return plan
+
+def read_project_stats (filename):
+    """Read number of changes per project found in previous runs.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the project stats file (JSON).
 
     Returns
     -------
 
-    int: Number of retrieved records, counting from records up.
+    dict: number of changes by project (empty if the file does not exist).
+
+    """
+
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open (filename, "r") as stats_file:
+        return json.loads(stats_file.read())
+
+def write_project_stats (filename, stats, engine, counts = None):
+    """Update number of changes per project with those found by an engine.
+
+    Since projects only grow, the largest of the previous and the
+    current number is kept (so that incremental runs, which retrieve
+    only some changes, do not reduce it). Projects in streams which
+    were completed with no changes found are kept too (with 0
+    changes, if they were not known), as are projects counted (see
+    count_changes), so that they are not counted again in next runs.
+
+    Parameters
+    ----------
+
+    filename: str
+        Name of the project stats file (JSON).
+    stats: dict
+        Previous number of changes by project.
+    engine: Engine
+        Engine with the number of changes found by project.
+    counts: dict
+        Number of changes by project, counted by count_changes
+        (those unknown, infinite, are not kept) (Default: None).
 
     """
 
-    project_chuncks = [projects[i:i + size]
-                       for i in range(0, len(projects), size)]
-    for chunck in project_chuncks:
-        print "Projects: " + ", ".join(chunck) + "."
-        query = ["project:" + item for item in chunck]
-        or_query = []
-        for project in query:
-            or_query.extend([project, "OR"])
-        or_query.pop()
-        status_command = base_command + or_query
-        records = retrieve (file, status_command, records)
-    return records
+    found = dict([(project, 0) for project
+                  in engine.completed - engine.failed_projects])
+    found.update (engine.projects)
+    if counts is not None:
+        for project, changes in counts.items():
+            if changes != float("inf"):
+                found[project] = max(found.get(project, 0), changes)
+    for project, changes in found.items():
+        stats[project] = max(stats.get(project, 0), changes)
+    with open (filename, "w") as stats_file:
+        stats_file.write (json.dumps(stats, indent = 2, sort_keys = True))
+
+def time_slices (since, until, slices):
+    """Split a period in time slices, as query terms.
+
+    The first slice has no start, and the last slice has no end, so
+    that all changes are covered whatever their date. Slices are
+    specified with day granularity, and may overlap on their
+    boundary days (repeated changes are expected).
+
+    Parameters
+    ----------
+
+    since: datetime
+        Start of the period.
+    until: datetime
+        End of the period.
+    slices: int
+        Number of slices.
+
+    Returns
+    -------
+
+    list of list of str: query terms for each slice
+        (eg: ["after:2013-01-01", "before:2013-07-01"]).
+
+    """
+
+    step = (until - since) / slices
+    bounds = [(since + step * count).strftime("%Y-%m-%d")
+              for count in range(1, slices)]
+    if len(bounds) == 0:
+        return [[]]
+    windows = [["before:" + bounds[0]]]
+    for count in range(1, len(bounds)):
+        windows.append (["after:" + bounds[count - 1],
+                         "before:" + bounds[count]])
+    windows.append (["after:" + bounds[-1]])
+    return windows
+
+def slice_streams (streams, windows):
+    """Split streams in time slices.
+
+    Parameters
+    ----------
+
+    streams: list of (list of str, str)
+        Streams, as (query, sortkey) (see Engine.run), with no
+        sortkey (None), since a sortkey is only valid for the query
+        it was found in, not for its slices.
+    windows: list of list of str
+        Query terms for each slice (see time_slices).
+
+    Returns
+    -------
+
+    list of (list of str, str): streams, one per stream and slice.
+
+    """
+
+    if any([sortkey is not None for (query, sortkey) in streams]):
+        raise ValueError ("Streams with sortkey cannot be sliced.")
+    return [(query + window, None)
+            for (query, sortkey) in streams
+            for window in windows]
 
 if __name__ == "__main__":
 
     args = parse_args()
+    telemetry.emit_at_exit (args.stats)
     if args.projectlist:
         with open (args.projectlist, "r") as listfile:
             projects_json = listfile.read()
             projects = json.loads(projects_json)
-    with open (args.file, "w") as file:
+    loader = None
+    if args.database:
+        # Only needed (and imported) when loading to a database
+        import revisor_json
+        from revisor_db import build_engine
+        revisor_json.message_bodies = args.message_bodies
+        if args.stats:
+            revisor_json.telemetry.emit_at_exit (args.stats + ".load")
+        else:
+            revisor_json.telemetry.emit_at_exit ()
+        loader = revisor_json.Loader (
+            build_engine(args.database, createdb = args.createdb,
+                         load = True),
+            queue_size = args.queue_size, batch = args.batch,
+            deferred = args.deferred, incremental = args.incremental,
+            batch_bytes = args.batch_bytes, rejects = args.rejects)
+        loader.start()
+        print "Loading to database: " + args.database
+    if args.file:
+        file = open (args.file, "w")
         print "Writing to file: " + args.file
-        base_command = ["ssh", "-p", args.port, args.server, "gerrit", 
-                        "query", "--format=JSON", "--files",
+    else:
+        file = None
+    try:
+        query_command = ["ssh", "-p", args.port, args.server, "gerrit", 
+                         "query", "--format=JSON"]
+        base_command = query_command + ["--files",
                         "--comments", "--patch-sets", "--all-approvals",
                         "--commit-message", "--submit-records",
                         ]
-#                        "limit:2"]
 #                    "--dependencies"]
-        records = 0
+        engine = Engine(file, base_command, workers = args.workers,
+                        max_concurrency = args.max_concurrency,
+                        limit = args.limit, max_limit = args.max_limit,
+                        target = args.target, loader = loader)
+        streams = []
         if args.sortkey:
             sortkey = args.sortkey
         else:
@@ -205,10 +1023,68 @@ if __name__ == "__main__":
         if args.status:
             statuses = args.status.split(",")
             for status in statuses:
-                print "Status: " + status + "." 
-                status_command = base_command + ["status:" + status]
-                records = retrieve (file, status_command, records, sortkey)
+                streams.append ((["status:" + status], sortkey))
+        counts = None
         if args.projectlist:
-            records = retrieve_projects (file, base_command,
-                                         records, projects)
-    print "Done."
+            project_stats = read_project_stats (args.project_stats)
+            unknown = [project for project in projects
+                       if project not in project_stats]
+            if len(unknown) > 0:
+                print "Counting changes for " + str(len(unknown)) + \
+                    " projects..."
+                counts = count_changes (engine, query_command, unknown,
+                                        batch = args.chunck_projects)
+                project_stats.update (counts)
+            plan = plan_projects (projects, project_stats,
+                                  args.chunck_changes, args.chunck_projects)
+            print "Plan: " + str(len(plan)) + " chuncks for " + \
+                str(len(projects)) + " projects (" + \
+                str(len([chunck for (changes, chunck) in plan
+                         if len(chunck) == 1])) + \
+                " with a single project)."
+            streams.extend ([(or_query (chunck), None)
+                             for (changes, chunck) in plan])
+        if args.state:
+            state = read_state (args.state)
+            streams = [(since_query (query, state), sortkey)
+                       for (query, sortkey) in streams]
+        if args.slices:
+            started = datetime.utcnow()
+            since = datetime.strptime(args.since, "%Y-%m-%d")
+            if args.until:
+                until = datetime.strptime(args.until, "%Y-%m-%d")
+            else:
+                until = started
+            records = engine.run (
+                slice_streams (streams,
+                               time_slices (since, until, args.slices)))
+            # Changes updated while retrieving may have moved to a slice
+            # already retrieved: retrieve again those updated since start
+            records = engine.run (
+                slice_streams (streams,
+                               [["after:" + (started - timedelta(days = 1)) \
+                                     .strftime("%Y-%m-%d")]]))
+        else:
+            records = engine.run (streams)
+        if args.state:
+            write_state (args.state, state, engine)
+        if args.project_stats:
+            write_project_stats (args.project_stats,
+                                 read_project_stats (args.project_stats),
+                                 engine, counts)
+    finally:
+        if file is not None:
+            file.close()
+    if loader is not None:
+        # Repeated changes (eg, from slices) were replaced while loading
+        loaded = loader.finish()
+        print "Changes loaded: " + str(loaded) + " (rejected: " + \
+            str(loader.writer.rejected) + ")."
+    if args.slices and args.file:
+        with telemetry.stage("dedup"):
+            os.rename (args.file, args.file + ".slices")
+            (read, records) = dedup (args.file + ".slices", args.file)
+            os.remove (args.file + ".slices")
+        print "Repeated changes removed: " + str(read - records) + "."
+    telemetry.progress(force = True)
+    print "Done (" + str(records) + " records)."
@@ -0,0 +1,579 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2014 Bitergia
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+##
+## Package to instrument revisor retrievers and loaders: time spent
+## per stage, rows per table, progress lines and summaries.
+##
+## Authors:
+##   Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
+##
+
+from contextlib import contextmanager
+from time import time
+import atexit
+import json
+import sys
+import threading
+
+class Telemetry (object):
+    """Instrumentation for a run of a retriever or loader.
+
+    Keeps time spent per stage (stages may be nested, in which case
+    time is accounted for both), and number of rows per table (or
+    per any other kind of counted item). Progress lines are printed
+    at most once per interval seconds, and a summary (JSON) can be
+    emitted when the program exits. Can be used from several threads.
+
+    """
+
+    def __init__ (self, name, interval = 10, out = sys.stderr):
+        """Initialize instrumentation.
+
+        Parameters
+        ----------
+
+        name: str
+            Name of the instrumented program (used in progress lines).
+        interval: float
+            Minimum number of seconds between progress lines
+            (Default: 10).
+        out: file
+            File to write progress lines to (Default: sys.stderr).
+
+        """
+
+        self.name = name
+        self.interval = interval
+        self.out = out
+        self.started = time()
+        self.last_progress = self.started
+        self.stages = {}
+        self.counts = {}
+        # Counts held (see hold), by thread
+        self.held = threading.local()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage (self, name):
+        """Context manager to account for time spent in a stage.
+
+        Parameters
+        ----------
+
+        name: str
+            Name of the stage (eg: "fetch", "decode", "commit").
+
+        """
+
+        started = time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                (seconds, calls) = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + time() - started, calls + 1)
+
+    def count (self, name, rows = 1):
+        """Count rows for a table (or any other kind of item).
+
+        Parameters
+        ----------
+
+        name: str
+            Name of the table (or kind of item).
+        rows: int
+            Number of rows to add (Default: 1).
+
+        """
+
+        held = getattr(self.held, "counts", None)
+        if held is not None:
+            held[name] = held.get(name, 0) + rows
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + rows
+
+    def hold (self):
+        """Hold counts made from this thread, until released (see release).
+
+        Useful for counting rows that may be rolled back (eg, those in
+        a savepoint), only if they are finally written.
+
+        """
+
+        self.held.counts = {}
+
+    def release (self, discard = False):
+        """Stop holding counts made from this thread (see hold).
+
+        Parameters
+        ----------
+
+        discard: bool
+            Discard counts held, instead of counting them
+            (Default: False).
+
+        """
+
+        held = getattr(self.held, "counts", None)
+        self.held.counts = None
+        if held is None or discard:
+            return
+        with self.lock:
+            for name, rows in held.items():
+                self.counts[name] = self.counts.get(name, 0) + rows
+
+    def elapsed (self):
+        """Seconds since instrumentation started.
+
+        """
+
+        # Avoid zero elapsed times (rates are divided by them)
+        return max(time() - self.started, 1e-6)
+
+    def progress (self, force = False):
+        """Print a progress line, if interval seconds passed since last one.
+
+        Parameters
+        ----------
+
+        force: bool
+            Print even if interval did not pass (Default: False).
+
+        """
+
+        now = time()
+        if not force and (now - self.last_progress) < self.interval:
+            return
+        self.last_progress = now
+        elapsed = self.elapsed()
+        rates = ["%s: %d (%.1f/s)" % (name, rows, rows / elapsed)
+                 for name, rows in sorted(self.counts.items())]
+        self.out.write ("[" + self.name + "] %.1f secs. " % elapsed \
+                            + ", ".join(rates) + "\n")
+        self.out.flush()
+
+    def summary (self):
+        """Produce a summary of the run, as a dictionary.
+
+        Returns
+        -------
+
+        dict: summary, with "name", "elapsed" (seconds), "stages"
+            (seconds and calls per stage) and "rows" (rows and rows
+            per second for each table).
+
+        """
+
+        elapsed = self.elapsed()
+        stages = {}
+        for name, (seconds, calls) in self.stages.items():
+            stages[name] = {"seconds": round(seconds, 3), "calls": calls}
+        rows = {}
+        for name, count in self.counts.items():
+            rows[name] = {"rows": count,
+                          "per_sec": round(count / elapsed, 1)}
+        return {"name": self.name,
+                "elapsed": round(elapsed, 3),
+                "stages": stages,
+                "rows": rows}
+
+    def merge (self, summary):
+        """Add stages and rows from the summary of another run.
+
+        Useful to account here for work done by other processes
+        (eg, parallel writers), which produce their own summary.
+
+        Parameters
+        ----------
+
+        summary: dict
+            Summary of the other run (see summary).
+
+        """
+
+        with self.lock:
+            for name, stage in summary["stages"].items():
+                (seconds, calls) = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + stage["seconds"],
+                                     calls + stage["calls"])
+            for name, rows in summary["rows"].items():
+                self.counts[name] = self.counts.get(name, 0) + rows["rows"]
+
+    def emit (self, filename = None):
+        """Emit the summary, as JSON.
+
+        Parameters
+        ----------
+
+        filename: str
+            File to write summary to (Default: None, means write it
+            as a single line to out).
+
+        """
+
+        summary = json.dumps(self.summary(), sort_keys = True)
+        if filename is None:
+            self.out.write (summary + "\n")
+        else:
+            with open (filename, "w") as stats_file:
+                stats_file.write (summary + "\n")
+
+    def emit_at_exit (self, filename = None):
+        """Emit the summary when the program exits (see emit).
+
+        """
+
+        atexit.register (self.emit, filename)
+
+class Profiler (object):
+    """Profile of the steps of a program running SQL queries.
+
+    For each step (eg, a function producing a report), keeps its
+    calls and wall time, and time spent in phases: "db" (executing
+    SQL statements, from SQLAlchemy engine events), "fetch" (getting
+    rows and building objects or arrays with them), and any other
+    phase marked by the program (eg, "pandas"). For each SQL statement
+    run in a step, keeps calls, time executing it, and rows fetched,
+    and optionally its plan (EXPLAIN). Phases and statements are
+    accounted for the innermost step running when they happen (also
+    if they happen in other threads, in which case times in phases
+    may add up to more than the wall time of the step).
+
+    If not enabled, steps and phases are ignored.
+
+    """
+
+    def __init__ (self, enabled = True, out = sys.stderr):
+        """Initialize profile.
+
+        Parameters
+        ----------
+
+        enabled: bool
+            Profile (Default: True).
+        out: file
+            File to write the ranked table to (Default: sys.stderr).
+
+        """
+
+        self.enabled = enabled
+        self.out = out
+        self.started = time()
+        self.steps = {}
+        self.statements = {}
+        self.stack = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def current (self):
+        """Name of the innermost step running ("(other)" if none is).
+
+        """
+
+        if len(self.stack) == 0:
+            return "(other)"
+        return self.stack[-1]
+
+    def step_stats (self, name):
+        """Stats for a step (created if needed, should hold lock).
+
+        """
+
+        if name not in self.steps:
+            self.steps[name] = {"calls": 0, "seconds": 0.0, "rows": 0,
+                                "phases": {}}
+        return self.steps[name]
+
+    @contextmanager
+    def step (self, name):
+        """Context manager to profile a step.
+
+        Parameters
+        ----------
+
+        name: str
+            Name of the step (eg: "get_events").
+
+        """
+
+        if not self.enabled:
+            yield
+            return
+        self.stack.append (name)
+        started = time()
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            with self.lock:
+                stats = self.step_stats (name)
+                stats["calls"] = stats["calls"] + 1
+                stats["seconds"] = stats["seconds"] + time() - started
+
+    def add_phase (self, phase, seconds, step = None):
+        """Add time to a phase of a step (Default: current step).
+
+        """
+
+        if step is None:
+            step = self.current()
+        with self.lock:
+            phases = self.step_stats (step)["phases"]
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase (self, name):
+        """Context manager to account for time spent in a phase.
+
+        Parameters
+        ----------
+
+        name: str
+            Name of the phase (eg: "pandas").
+
+        """
+
+        if not self.enabled:
+            yield
+            return
+        started = time()
+        try:
+            yield
+        finally:
+            self.add_phase (name, time() - started)
+
+    def add_rows (self, rows):
+        """Add rows fetched for the last statement run in this thread.
+
+        """
+
+        if not self.enabled:
+            return
+        key = getattr(self.local, "statement", None)
+        with self.lock:
+            self.step_stats (self.current())["rows"] += rows
+            if key in self.statements:
+                self.statements[key]["rows"] += rows
+
+    def fetched (self, rows):
+        """Iterate over rows, accounting for time and rows in "fetch".
+
+        """
+
+        step = self.current()
+        (count, seconds) = (0, 0.0)
+        iterator = iter(rows)
+        try:
+            while True:
+                started = time()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds = seconds + time() - started
+                count = count + 1
+                yield row
+        finally:
+            self.add_phase ("fetch", seconds, step)
+            self.add_rows (count)
+
+    def query_class (self, base):
+        """Produce a subclass of a SQLAlchemy Query class, profiling fetches.
+
+        Iterating over the results of queries (which is what all(),
+        one(), count(), etc. do) is accounted for in the "fetch"
+        phase, and the rows produced are counted.
+
+        """
+
+        profiler = self
+
+        class ProfiledQuery (base):
+
+            def __iter__ (self):
+                rows = super(ProfiledQuery, self).__iter__()
+                if not profiler.enabled:
+                    return rows
+                return profiler.fetched (rows)
+
+        return ProfiledQuery
+
+    def before_execute (self, conn, cursor, statement, parameters,
+                        context, executemany):
+
+        self.local.execute_started = time()
+
+    def after_execute (self, conn, cursor, statement, parameters,
+                       context, executemany):
+
+        if not self.enabled:
+            return
+        seconds = time() - self.local.execute_started
+        step = self.current()
+        key = (step, statement)
+        self.local.statement = key
+        with self.lock:
+            phases = self.step_stats (step)["phases"]
+            phases["db"] = phases.get("db", 0.0) + seconds
+            if key not in self.statements:
+                self.statements[key] = {"step": step, "sql": statement,
+                                        "parameters": parameters,
+                                        "calls": 0, "seconds": 0.0,
+                                        "rows": 0}
+            stats = self.statements[key]
+            stats["calls"] = stats["calls"] + 1
+            stats["seconds"] = stats["seconds"] + seconds
+
+    def attach (self, engine):
+        """Listen to SQL statements run by engine (and its connections).
+
+        """
+
+        from sqlalchemy import event
+
+        event.listen (engine, "before_cursor_execute", self.before_execute)
+        event.listen (engine, "after_cursor_execute", self.after_execute)
+
+    def explain (self, engine):
+        """Get the plan of SELECT statements run (EXPLAIN).
+
+        Plans are stored as "explain" (list of rows, as strings) in
+        the stats for each statement.
+
+        """
+
+        if engine.dialect.name == "sqlite":
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            prefix = "EXPLAIN "
+        self.enabled = False
+        connection = engine.connect()
+        try:
+            for stats in self.statements.values():
+                if not stats["sql"].lstrip().upper().startswith("SELECT"):
+                    continue
+                try:
+                    cursor = connection.connection.cursor()
+                    cursor.execute (prefix + stats["sql"],
+                                    stats["parameters"])
+                    stats["explain"] = [" ".join([str(column)
+                                                  for column in row])
+                                        for row in cursor.fetchall()]
+                    cursor.close()
+                except Exception as error:
+                    stats["explain"] = ["Error: " + str(error)]
+        finally:
+            connection.close()
+
+    def summary (self):
+        """Produce a summary of the profile, as a dictionary.
+
+        Returns
+        -------
+
+        dict: summary, with "elapsed" (seconds), "steps" (calls,
+            seconds, rows and seconds per phase for each step) and
+            "statements" (step, sql, calls, seconds, rows, and maybe
+            explain, for each statement; slowest first).
+
+        """
+
+        steps = {}
+        for name, stats in self.steps.items():
+            steps[name] = {
+                "calls": stats["calls"],
+                "seconds": round(stats["seconds"], 3),
+                "rows": stats["rows"],
+                "phases": dict([(phase, round(seconds, 3)) for phase, seconds
+                                in stats["phases"].items()])
+                }
+        statements = []
+        for stats in sorted(self.statements.values(),
+                            key = lambda stats: stats["seconds"],
+                            reverse = True):
+            statement = dict([(key, value) for key, value in stats.items()
+                              if key != "parameters"])
+            statement["seconds"] = round(stats["seconds"], 3)
+            statements.append (statement)
+        return {"elapsed": round(time() - self.started, 3),
+                "steps": steps,
+                "statements": statements}
+
+    def ranked (self, phases = ["db", "fetch", "pandas"], statements = 10):
+        """Produce a ranked table of steps (slowest first), as a string.
+
+        The slowest statements (with their plan, if available) are
+        shown after the table.
+
+        """
+
+        summary = self.summary()
+        lines = ["%-32s %6s %9s " % ("step", "calls", "seconds") + \
+                     " ".join(["%9s" % phase for phase in phases]) + \
+                     " %10s" % "rows"]
+        for name, stats in sorted(summary["steps"].items(),
+                                  key = lambda item: item[1]["seconds"],
+                                  reverse = True):
+            lines.append ("%-32s %6d %9.3f " % (name[:32], stats["calls"],
+                                                 stats["seconds"]) + \
+                              " ".join(["%9.3f" % stats["phases"].get(phase,
+                                                                      0.0)
+                                        for phase in phases]) + \
+                              " %10d" % stats["rows"])
+        for stats in summary["statements"][:statements]:
+            lines.append ("")
+            lines.append ("%.3f secs., %d calls, %d rows (%s): " % \
+                              (stats["seconds"], stats["calls"],
+                               stats["rows"], stats["step"]) + \
+                              " ".join(stats["sql"].split())[:200])
+            for row in stats.get("explain", []):
+                lines.append ("    " + row)
+        return "\n".join(lines) + "\n"
+
+    def emit (self, filename = None, engine = None):
+        """Write the ranked table to out, and the summary (JSON) to a file.
+
+        Parameters
+        ----------
+
+        filename: str
+            File to write summary to (Default: None, means no summary).
+        engine: sqlalchemy.engine.Engine
+            Engine to get the plans of statements (see explain)
+            (Default: None, means no plans).
+
+        """
+
+        if engine is not None:
+            self.explain (engine)
+        self.out.write (self.ranked())
+        self.out.flush()
+        if filename is not None:
+            with open (filename, "w") as profile_file:
+                profile_file.write (json.dumps(self.summary(),
+                                               sort_keys = True) + "\n")
+
+    def emit_at_exit (self, filename = None, engine = None):
+        """Emit the profile when the program exits (see emit).
+
+        """
+
+        atexit.register (self.emit, filename, engine)